@@ -0,0 +1,149 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+
+Benchmark of the control loop against a simulated hwmon tree.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_loop --fans 1 10 100 300
+
+For each number of fans a simulated tree is built (see `simulator`) and the
+controller is run without sleeping. Reported per configuration:
+
+ - ticks/s and per tick latency percentiles, with the thermal model reacting
+   to written PWM values between ticks
+ - read and write syscalls per tick, from /proc/self/io, in steady state
+ - net allocated memory blocks per tick and the mean transient memory peak of
+   a tick, from tracemalloc, in steady state
+"""
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import yaml
+from hhfc import config, controller, hwmon
+from benchmarks.simulator import SimulatedHwmon
+
+
+def read_syscalls() -> int:
+    """Returns the read and write syscalls done by this process so far"""
+    counters = {}
+    with open("/proc/self/io", encoding="utf-8") as proc_io:
+        for line in proc_io:
+            key, value = line.split(":")
+            counters[key] = int(value)
+    return counters["syscr"] + counters["syscw"]
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Nearest rank percentile of sorted `values`"""
+    rank = max(math.ceil(len(values) * percent / 100.0) - 1, 0)
+    return values[rank]
+
+
+def bench(fans: int, ticks: int, fans_per_driver: int, sensors_per_driver: int) -> dict:
+    """Run the benchmark for a tree with `fans` fans"""
+    with tempfile.TemporaryDirectory(prefix="hhfc-bench-") as tmp:
+        simulation = SimulatedHwmon(os.path.join(tmp, "hwmon"),
+                                    fans=fans,
+                                    fans_per_driver=fans_per_driver,
+                                    sensors_per_driver=sensors_per_driver)
+        simulation.create()
+        interval = 1.0
+        config_path = os.path.join(tmp, "fan_control.yaml")
+        with open(config_path, "w", encoding="utf-8") as config_file:
+            yaml.safe_dump(simulation.config(interval), config_file)
+
+        hwmon.set_root(simulation.root)
+        control = controller.controller_from_config(config.Config(config_path))
+        control._take_over_fans()
+
+        # Closed loop run, the simulation reacts to the written values
+        now = 0.0
+        durations = []
+        for _ in range(ticks):
+            start = time.perf_counter()
+            now = control._loop_iter(now)
+            durations.append(time.perf_counter() - start)
+            simulation.step(interval)
+        durations.sort()
+
+        # Steady state, nothing else touching files or allocating
+        syscalls = read_syscalls()
+        for _ in range(ticks):
+            now = control._loop_iter(now)
+        syscalls = read_syscalls() - syscalls
+
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        transient = 0
+        for _ in range(ticks):
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            now = control._loop_iter(now)
+            transient += tracemalloc.get_traced_memory()[1] - current
+        blocks = sys.getallocatedblocks() - blocks
+        tracemalloc.stop()
+
+        control._release_fans()
+        writes = sum(fan.writes_issued for fan in control.fans)
+
+    return {
+        "fans": len(control.fans),
+        "sensors": len(control.sensors),
+        "ticks_per_second": len(durations) / sum(durations),
+        "p50": percentile(durations, 50),
+        "p90": percentile(durations, 90),
+        "p99": percentile(durations, 99),
+        "syscalls": syscalls / ticks,
+        "blocks": blocks / ticks,
+        "transient": transient / ticks,
+        "writes": writes,
+    }
+
+
+def main():
+    """Run the benchmarks and print a table with the results"""
+    parser = argparse.ArgumentParser(description="hhfc control loop benchmark")
+    parser.add_argument("--fans", type=int, nargs="+", default=[1, 10, 100, 300],
+                        help="Numbers of fans to benchmark with")
+    parser.add_argument("--ticks", type=int, default=1000,
+                        help="Loop iterations per measurement")
+    parser.add_argument("--fans-per-driver", type=int, default=4,
+                        help="Fans of each simulated driver")
+    parser.add_argument("--sensors-per-driver", type=int, default=2,
+                        help="Temperature sensors of each simulated driver")
+    args = parser.parse_args()
+
+    print(f"{'fans':>5} {'sensors':>7} {'ticks/s':>10} {'p50 us':>9} {'p90 us':>9} "
+          f"{'p99 us':>9} {'sysc/tick':>9} {'blk/tick':>8} {'B/tick':>8} {'writes':>7}")
+    for fans in args.fans:
+        result = bench(fans, args.ticks, args.fans_per_driver, args.sensors_per_driver)
+        print(f"{result['fans']:>5} {result['sensors']:>7} "
+              f"{result['ticks_per_second']:>10.0f} "
+              f"{result['p50'] * 1e6:>9.1f} {result['p90'] * 1e6:>9.1f} "
+              f"{result['p99'] * 1e6:>9.1f} {result['syscalls']:>9.1f} "
+              f"{result['blocks']:>8.2f} {result['transient']:>8.0f} "
+              f"{result['writes']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+
+# Raw value range of simulated PWM attributes
+PWM_MAX = 255
+
+# Temperature curve used by every simulated fan
+CURVE = [
+    [35, 0], [40, 15], [45, 25], [50, 35], [55, 45],
+    [60, 55], [65, 65], [70, 75], [75, 85], [80, 100],
+]
+
+
+class SimulatedDriver:
+    """A simulated hwmon driver with temperature sensors and fans. All its
+    sensors share one thermal mass heated by a constant load and cooled by
+    its fans
+    """
+
+    name: str
+    path: str
+    sensors: int
+    fans: int
+    temperature: float
+
+    def __init__(self, name: str, path: str, sensors: int, fans: int, temperature: float):
+        self.name = name
+        self.path = path
+        self.sensors = sensors
+        self.fans = fans
+        self.temperature = temperature
+
+    def create(self) -> None:
+        """Create the hwmon directory and its attribute files"""
+        os.makedirs(self.path)
+        self._write("name", self.name)
+        for sensor in range(1, self.sensors + 1):
+            self._write(f"temp{sensor}_input", 0)
+        for fan in range(1, self.fans + 1):
+            self._write(f"pwm{fan}", 0)
+            self._write(f"pwm{fan}_enable", 0)
+            self._write(f"fan{fan}_input", 0)
+        self.publish()
+
+    def _write(self, attribute: str, value) -> None:
+        with open(os.path.join(self.path, attribute), "w", encoding="utf-8") as attr:
+            attr.write(f"{value}\n")
+
+    def _read(self, attribute: str) -> int:
+        with open(os.path.join(self.path, attribute), encoding="utf-8") as attr:
+            # Writers do not truncate, like sysfs, only the first line counts
+            return int(attr.readline())
+
+    def duties(self) -> list[float]:
+        """Returns the duty cycle in [0-1] written to each fan"""
+        return [self._read(f"pwm{fan}") / PWM_MAX for fan in range(1, self.fans + 1)]
+
+    def publish(self) -> None:
+        """Write the current temperature and fan speeds to the attributes"""
+        for sensor in range(1, self.sensors + 1):
+            # Spread sensors of the same driver a bit
+            self._write(f"temp{sensor}_input", int((self.temperature + sensor - 1) * 1000))
+        for fan, duty in enumerate(self.duties(), start=1):
+            self._write(f"fan{fan}_input", int(duty * 5000))
+
+
+class SimulatedHwmon:
+    """A hwmon tree under `root` with `fans` fans spread in simulated drivers
+    of `fans_per_driver` fans and `sensors_per_driver` sensors. The thermal
+    model of each driver follows
+
+        C dT/dt = load - (idle_cooling + fan_cooling * mean_duty) (T - ambient)
+
+    so temperatures react to the PWM values written by the controller
+    """
+
+    root: str
+    drivers: list[SimulatedDriver]
+    ambient: float
+    load: float
+    capacity: float
+    idle_cooling: float
+    fan_cooling: float
+
+    def __init__(self,
+                 root: str,
+                 fans: int = 1,
+                 fans_per_driver: int = 1,
+                 sensors_per_driver: int = 1,
+                 ambient: float = 30.0,
+                 load: float = 60.0,
+                 ):
+        self.root = root
+        self.ambient = ambient
+        self.load = load
+        self.capacity = 20.0
+        self.idle_cooling = 0.5
+        self.fan_cooling = 3.0
+        self.drivers = []
+        while fans > 0:
+            idx = len(self.drivers)
+            self.drivers.append(SimulatedDriver(f"simdrv{idx}",
+                                                os.path.join(root, f"hwmon{idx}"),
+                                                sensors_per_driver,
+                                                min(fans, fans_per_driver),
+                                                ambient + 20.0))
+            fans -= fans_per_driver
+
+    def create(self) -> None:
+        """Create the hwmon tree"""
+        os.makedirs(self.root, exist_ok=True)
+        for driver in self.drivers:
+            driver.create()
+
+    def step(self, seconds: float) -> None:
+        """Advance the thermal model `seconds` and publish the new state"""
+        for driver in self.drivers:
+            duties = driver.duties()
+            mean_duty = sum(duties) / len(duties) if duties else 0.0
+            cooling = (self.idle_cooling + self.fan_cooling * mean_duty) \
+                * (driver.temperature - self.ambient)
+            driver.temperature += (self.load - cooling) * seconds / self.capacity
+            driver.publish()
+
+    def config(self, interval: float = 1.0) -> dict:
+        """Returns a hhfc configuration using every sensor and fan of the
+        tree. Each fan watches all sensors of its driver
+        """
+        sensors = []
+        fans = []
+        for driver in self.drivers:
+            names = []
+            for sensor in range(1, driver.sensors + 1):
+                names.append(f"{driver.name}_temp{sensor}")
+                sensors.append({
+                    "name": names[-1],
+                    "driver_name": driver.name,
+                    "temp_input": f"temp{sensor}_input",
+                })
+            for fan in range(1, driver.fans + 1):
+                fans.append({
+                    "name": f"{driver.name}_fan{fan}",
+                    "driver_name": driver.name,
+                    "handle": f"pwm{fan}",
+                    "fan_input": f"fan{fan}_input",
+                    "max_control_value": PWM_MAX,
+                    "sensors": [{"name": name, "curve": CURVE} for name in names],
+                })
+        return {"INTERVAL": interval, "SENSORS": sensors, "FANS": fans}
@@ -18,7 +18,9 @@ with hhfc. If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
 import logging
-from hhfc import config, fan, sensor, controller
+import signal
+import time
+from hhfc import config, controller, hwmon
 
 
 def arg_parse():
@@ -36,6 +38,35 @@ def arg_parse():
                         action='store_true',
                         help="Monitor mode. When set the fans duty cycles are not modified"
                         )
+    parser.add_argument('--hwmon-root',
+                        action='store',
+                        type=str,
+                        default=hwmon.HWMON_ROOT,
+                        help="Directory to look for hwmon devices in"
+                        )
+    parser.add_argument('--config-cache',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help="Directory to cache the parsed configuration in, for faster startup"
+                        )
+    parser.add_argument('--calibrate',
+                        action='store_true',
+                        help="Measure the speed response of every fan and store it in "
+                             "CALIBRATION_FILE, then exit"
+                        )
+    parser.add_argument('--calibrate-max-temp',
+                        action='store',
+                        type=float,
+                        default=80.0,
+                        help="Abort calibration if any sensor reaches this temperature"
+                        )
+    parser.add_argument('--calibrate-steps',
+                        action='store',
+                        type=int,
+                        default=16,
+                        help="Number of PWM steps to measure each fan at"
+                        )
     parser.add_argument('-l', '--loglevel',
                         action='store',
                         type=str,
@@ -72,20 +103,64 @@ def main():
     setup_logging(args.loglevel)
 
     # Read configuration
-    conf = config.Config(args.config_file)
-
-    fan_list = []
-    for fan_conf in conf.get_fans_config():
-        fan_list.append(fan.Fan(fan_conf))
-
-    sensor_list = []
-    for sensor_conf in conf.get_sensors_config():
-        sensor_list.append(sensor.Sensor(sensor_conf))
-
-    interval = conf.get_interval()
-
-    control = controller.Controller(fan_list, sensor_list, interval, args.monitor)
-    control.run()
+    start = time.monotonic()
+    conf = config.Config(args.config_file, cache_dir=args.config_cache)
+    hwmon.set_root(args.hwmon_root)
+
+    if args.calibrate:
+        from hhfc import calibrate
+        if not calibrate.run_calibration(conf, args.calibrate_max_temp, args.calibrate_steps):
+            raise SystemExit(1)
+        return
+
+    # Optional parts are imported only when used, to start faster
+    if conf.get_engine() == "asyncio":
+        from hhfc import engine
+        control = engine.engine_from_config(conf, args.monitor)
+        if conf.get_trace_file():
+            logging.warning("TRACE_FILE is not supported by the asyncio engine, not recording")
+    else:
+        control = controller.controller_from_config(conf, args.monitor)
+    logging.debug("Configuration loaded and devices found in %.1fms",
+                  (time.monotonic() - start) * 1000
+                  )
+
+    if conf.get_trace_file() and isinstance(control, controller.Controller):
+        from hhfc import trace
+        try:
+            control.recorder = trace.TraceWriter(conf.get_trace_file(),
+                                                 [sens.name for sens in control.sensors],
+                                                 [fan.name for fan in control.fans]
+                                                 )
+        except OSError as exp:
+            logging.error("Could not open trace %s, not recording: %s", conf.get_trace_file(), exp)
+
+    metrics_conf = conf.get_metrics_config()
+    exporter = None
+    if metrics_conf["socket_path"] or metrics_conf["textfile_path"]:
+        from hhfc import metrics
+        exporter = metrics.MetricsExporter(control, **metrics_conf)
+        exporter.start()
+
+    def reload_config(signum, frame):
+        logging.info("Got SIGHUP, reloading configuration from %s", args.config_file)
+        control.reload(config.Config(args.config_file, cache_dir=args.config_cache))
+
+    signal.signal(signal.SIGHUP, reload_config)
+
+    # Stopping the loop runs its cleanup: alarm limits are restored and fans
+    # released, which the default SIGTERM action would skip
+    def stop(signum, frame):
+        logging.info("Got SIGTERM, stopping")
+        control.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        control.run()
+    finally:
+        if exporter is not None:
+            exporter.stop()
 
 
 if __name__ == '__main__':
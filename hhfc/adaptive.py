@@ -0,0 +1,103 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import collections
+import logging
+from hhfc.sensor import Sensor
+
+# Factor the interval grows by on each stable iteration
+BACKOFF_FACTOR = 1.5
+
+# Window used to count wakeups, in seconds
+WAKEUP_WINDOW = 60.0
+
+
+class IntervalAdapter:
+    """Adapts the polling interval to how stable temperatures are. While all
+    readings stay within `deadband` degrees and no fan duty cycle changes
+    the intervals grow up to `max_interval`. As soon as any reading moves
+    more than `threshold` degrees they go back to their base value
+    """
+
+    max_interval: float
+    deadband: float
+    threshold: float
+    scale: float
+    references: dict[str, float]
+
+    def __init__(self, max_interval: float, deadband: float, threshold: float):
+        self.max_interval = max_interval
+        self.deadband = deadband
+        self.threshold = threshold
+        self.scale = 1.0
+        self.references = {}
+        self._wakeups = collections.deque()
+
+    def reset(self) -> None:
+        """Go back to base intervals and forget reference readings"""
+        self.scale = 1.0
+        self.references.clear()
+
+    def scale_interval(self, interval: float) -> float:
+        """Returns the effective value of a base `interval`"""
+        if self.scale == 1.0:
+            return interval
+        return min(interval * self.scale, max(interval, self.max_interval))
+
+    def wakeup(self, now: float) -> None:
+        """Record a wakeup of the control loop at `now`"""
+        self._wakeups.append(now)
+        while self._wakeups[0] < now - WAKEUP_WINDOW:
+            self._wakeups.popleft()
+
+    def get_wakeups_per_minute(self) -> int:
+        """Returns the number of wakeups during the last minute"""
+        return len(self._wakeups)
+
+    def update(self, sensors: list[Sensor], duty_changed: bool, base_interval: float) -> bool:
+        """Update the interval scale with new readings of `sensors`. Returns
+        True when the intervals snapped back to their base value
+        """
+        stable = not duty_changed
+        moved = False
+        for sensor in sensors:
+            if sensor.value is None:
+                continue
+            reference = self.references.get(sensor.name)
+            if reference is None:
+                self.references[sensor.name] = sensor.value
+                continue
+            delta = abs(sensor.value - reference)
+            if delta > self.deadband:
+                stable = False
+                self.references[sensor.name] = sensor.value
+            if delta > self.threshold:
+                moved = True
+
+        old_scale = self.scale
+        if moved:
+            self.scale = 1.0
+        elif stable:
+            self.scale = min(self.scale * BACKOFF_FACTOR,
+                             max(self.max_interval / base_interval, 1.0))
+        if self.scale != old_scale:
+            logging.debug("Adaptive interval: %.2fs (%i wakeups in the last minute)",
+                          self.scale_interval(base_interval),
+                          self.get_wakeups_per_minute()
+                          )
+        return moved and old_scale != 1.0
@@ -0,0 +1,98 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Batch evaluation of fan curves over arrays of temperatures, for offline
+# tools. NumPy is an optional dependency, the daemon never imports this module
+
+try:
+    import numpy as np
+except ImportError as exp:
+    raise ImportError("NumPy is needed for batch curve evaluation, install hhfc[tune]") from exp
+
+from hhfc.fan import Fan, Interpolator, LagrangeInterpolator
+
+
+def curve_values(curve: Interpolator, temperatures) -> np.ndarray:
+    """Evaluate `curve` at every temperature. Same results as calling
+    `curve.get_value` on each of them, including the precomputed table
+    lookup when the curve has a resolution
+    """
+    temps = np.asarray(temperatures, dtype=float)
+    x_vals = np.asarray(curve.x_vals, dtype=float)
+    y_vals = np.asarray(curve.y_vals, dtype=float)
+    inside = np.clip(temps, x_vals[0], x_vals[-1])
+    if curve.table is not None:
+        table = np.asarray(curve.table, dtype=float)
+        idx = ((inside - x_vals[0]) / curve.resolution + 0.5).astype(int)
+        values = table[np.minimum(idx, len(table) - 1)]
+    elif isinstance(curve, LagrangeInterpolator):
+        values = np.zeros_like(inside)
+        for j, y_val in enumerate(y_vals):
+            poly = np.ones_like(inside)
+            for m, x_val in enumerate(x_vals):
+                if m != j:
+                    poly *= (inside - x_val) / (x_vals[j] - x_val)
+            values += y_val * poly
+    else:
+        values = np.interp(inside, x_vals, y_vals)
+    values = np.where(temps >= x_vals[-1], y_vals[-1], values)
+    return np.where(temps <= x_vals[0], y_vals[0], values)
+
+
+def linear_curves(x_vals, y_vals, temperatures) -> np.ndarray:
+    """Evaluate many piecewise linear curves sharing the breakpoints
+    `x_vals`. `y_vals` has the duty cycles of each curve in its last axis
+    and broadcasts against `temperatures`, i.e. curves of shape (C, K) with
+    temperatures of shape (C,) evaluate each curve at its own temperature,
+    and a single curve of shape (K,) with temperatures of shape (N,) every
+    temperature on it. Below and above the breakpoints the first and last
+    values are used
+    """
+    x_vals = np.asarray(x_vals, dtype=float)
+    y_vals = np.asarray(y_vals, dtype=float)
+    temps = np.asarray(temperatures, dtype=float)
+    widths = np.diff(x_vals)
+    slopes = np.diff(y_vals, axis=-1) / widths
+    spans = np.clip(temps[..., np.newaxis] - x_vals[:-1], 0, widths)
+    return y_vals[..., 0] + (slopes * spans).sum(axis=-1)
+
+
+def limit_duty_cycles(fan: Fan, duty_cycles) -> np.ndarray:
+    """Apply the shutoff and min_value policy of `fan` to an array of duty
+    cycles, as `Fan.limit_duty_cycle` does
+    """
+    duty = np.asarray(duty_cycles, dtype=float)
+    return np.where(duty <= fan.min_allowed, 0 if fan.allow_shutoff else fan.min_allowed, duty)
+
+
+def desired_duty_cycles(fan: Fan, sensor: str, temperatures) -> np.ndarray:
+    """Duty cycles of `fan` for an array of readings of `sensor`, as
+    `Fan.get_desired_duty_cycle` returns for each of them
+    """
+    return limit_duty_cycles(fan, curve_values(fan.interpolator[sensor], temperatures))
+
+
+def fan_duty_cycles(fan: Fan, temperatures: dict) -> np.ndarray:
+    """Duty cycles the controller sets on `fan` for arrays of readings of its
+    sensors, by sensor name: the highest of its curves
+    """
+    duty = None
+    for sensor in fan.sensors:
+        values = desired_duty_cycles(fan, sensor["name"], temperatures[sensor["name"]])
+        duty = values if duty is None else np.maximum(duty, values)
+    return duty
@@ -0,0 +1,212 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import os
+import time
+from hhfc.config import Config
+from hhfc.fan import Fan, FanCalibration
+from hhfc.sensor import Sensor
+
+# Seconds between speed readings while waiting for a fan to settle
+SETTLE_INTERVAL = 0.5
+
+# A fan is settled when two consecutive readings differ less than this
+# fraction, or less than SETTLE_MIN_RPM
+SETTLE_TOLERANCE = 0.03
+SETTLE_MIN_RPM = 30
+
+# Give up waiting for a fan to settle after this many seconds
+SETTLE_TIMEOUT = 10.0
+
+DEFAULT_STEPS = 16
+DEFAULT_MAX_TEMPERATURE = 80.0
+
+
+class CalibrationAborted(Exception):
+    """A sensor got too hot while calibrating"""
+
+
+def check_temperatures(sensors: list[Sensor], max_temperature: float) -> None:
+    """Read every sensor and raise CalibrationAborted if any reached
+    `max_temperature`
+    """
+    for sensor in sensors:
+        value = sensor.sample()
+        if value >= max_temperature:
+            raise CalibrationAborted(f"Sensor {sensor.name} reached {value:.1f}")
+
+
+def wait_settled(fan: Fan, sensors: list[Sensor], max_temperature: float, sleep=time.sleep) -> int:
+    """Wait until the speed of `fan` stops changing and return it. Sensors are
+    checked on every reading
+    """
+    deadline = time.monotonic() + SETTLE_TIMEOUT
+    last = None
+    while True:
+        sleep(SETTLE_INTERVAL)
+        check_temperatures(sensors, max_temperature)
+        rpm = fan.read_input()
+        if last is not None and abs(rpm - last) <= max(last * SETTLE_TOLERANCE, SETTLE_MIN_RPM):
+            return rpm
+        if time.monotonic() > deadline:
+            logging.warning("fan %s: speed not settled after %.0fs, using %i RPM",
+                            fan.name,
+                            SETTLE_TIMEOUT,
+                            rpm
+                            )
+            return rpm
+        last = rpm
+
+
+def calibrate_fan(fan: Fan,
+                  sensors: list[Sensor],
+                  max_temperature: float = DEFAULT_MAX_TEMPERATURE,
+                  steps: int = DEFAULT_STEPS,
+                  sleep=time.sleep
+                  ) -> FanCalibration:
+    """Step a fan, already under control, down through its PWM range
+    recording the speed at each step until it stops. Then step it up again
+    from there to find the value that starts it. Returns the calibration
+    """
+    low, high = fan.min_val, fan.max_val
+    pwms = sorted({round(low + (high - low) * step / steps) for step in range(steps + 1)})
+
+    fan.set_pwm(high)
+    wait_settled(fan, sensors, max_temperature, sleep)
+    points = []
+    for pwm in reversed(pwms):
+        fan.set_pwm(pwm)
+        rpm = wait_settled(fan, sensors, max_temperature, sleep)
+        logging.info("fan %s: PWM %i, %i RPM", fan.name, pwm, rpm)
+        points.append((pwm, rpm))
+        if rpm == 0:
+            break
+
+    spinning = [pwm for pwm, rpm in points if rpm > 0]
+    if not spinning:
+        raise RuntimeError(f"fan {fan.name} does not spin, is fan_input right?")
+    stall_pwm = min(spinning)
+    start_pwm = stall_pwm
+    stopped_pwm = points[-1][0]
+    if points[-1][1] == 0:
+        points.extend((pwm, 0) for pwm in pwms if pwm < stopped_pwm)
+        start_pwm = max(spinning)
+        for pwm in pwms:
+            if stopped_pwm < pwm < start_pwm:
+                fan.set_pwm(pwm)
+                if wait_settled(fan, sensors, max_temperature, sleep) > 0:
+                    start_pwm = pwm
+                    break
+    logging.info("fan %s: stalls below PWM %i, starts at PWM %i", fan.name, stall_pwm, start_pwm)
+    return FanCalibration(fan.pwm_input.path, points, stall_pwm, start_pwm)
+
+
+def load_calibrations(path: str) -> dict[str, FanCalibration]:
+    """Load the calibrations stored at `path` by fan name"""
+    # Imported here, the daemon only needs it if CALIBRATION_FILE is set
+    import json
+    with open(path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    return {name: FanCalibration.from_dict(entry) for name, entry in data.items()}
+
+
+def save_calibrations(path: str, calibrations: dict[str, FanCalibration]) -> None:
+    """Store calibrations at `path`, replacing the file atomically"""
+    import json
+    data = {name: calibration.to_dict() for name, calibration in calibrations.items()}
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def apply_calibrations(fans: list[Fan], path: str) -> None:
+    """Set the calibration of every fan found in the file at `path`. A
+    calibration made for other hardware is ignored
+    """
+    if path is None:
+        return
+    try:
+        calibrations = load_calibrations(path)
+    except FileNotFoundError:
+        logging.info("No fan calibration at %s, run hhfc --calibrate to create it", path)
+        return
+    except (OSError, ValueError, KeyError, TypeError) as exp:
+        logging.warning("Could not load fan calibration from %s: %s", path, exp)
+        return
+    for fan in fans:
+        calibration = calibrations.get(fan.name)
+        if calibration is None:
+            continue
+        if calibration.pwm_path != fan.pwm_input.path:
+            logging.warning("fan %s: calibration was made for %s, not using it",
+                            fan.name,
+                            calibration.pwm_path
+                            )
+            continue
+        logging.debug("fan %s: using calibration, %i RPM max", fan.name, calibration.max_rpm)
+        fan.calibration = calibration
+
+
+def run_calibration(conf: Config,
+                    max_temperature: float = DEFAULT_MAX_TEMPERATURE,
+                    steps: int = DEFAULT_STEPS
+                    ) -> bool:
+    """Calibrate every configured fan, one at a time, and store the results
+    in the configured calibration file. Fans not being calibrated are left
+    under automatic control. Returns False if calibration was aborted
+    """
+    path = conf.get_calibration_file()
+    if path is None:
+        raise ValueError("CALIBRATION_FILE has to be set to calibrate fans")
+    sensors = [Sensor(sensor_conf) for sensor_conf in conf.get_sensors_config()]
+    zone_fans = [fan for zone in conf.get_zones_config() for fan in zone["fans"]]
+    fans = [Fan(fan_conf) for fan_conf in conf.get_fans_config() + zone_fans]
+
+    try:
+        calibrations = load_calibrations(path)
+    except (OSError, ValueError, KeyError, TypeError):
+        calibrations = {}
+
+    for fan in fans:
+        logging.info("Calibrating fan %s, aborting if any sensor reaches %.1f",
+                     fan.name,
+                     max_temperature
+                     )
+        try:
+            check_temperatures(sensors, max_temperature)
+        except CalibrationAborted as exp:
+            logging.error("Calibration not started: %s", exp)
+            return False
+        fan.take_control()
+        try:
+            calibrations[fan.name] = calibrate_fan(fan, sensors, max_temperature, steps)
+        except CalibrationAborted as exp:
+            logging.error("Calibration aborted: %s", exp)
+            return False
+        finally:
+            # Full speed before giving the fan back, in case firmware is slow
+            # to react
+            fan.set_pwm(fan.max_val)
+            fan.release_control()
+        save_calibrations(path, calibrations)
+    logging.info("Calibration stored at %s", path)
+    return True
@@ -16,31 +16,91 @@ A PARTICULAR PURPOSE. See the GNU General Public License for more details.
 with hhfc. If not, see <https://www.gnu.org/licenses/>.
 """
 
-import yaml
+import logging
+import marshal
+import os
+import zlib
+from hhfc.fan import INTERPOLATORS, Interpolator, intern_curve, dump_curves, load_curves
 
 # Default valoes for configuration
 ## Controller
 DEFAULT_INTERVAL = 1.0
+DEFAULT_SAMPLING = "serial"
+DEFAULT_SAMPLING_WORKERS = 4
+DEFAULT_ADAPTIVE_MAX_INTERVAL = 0
+DEFAULT_STATS_INTERVAL = 0
+DEFAULT_METRICS_SOCKET = None
+DEFAULT_METRICS_TEXTFILE = None
+DEFAULT_METRICS_TEXTFILE_INTERVAL = 10.0
+DEFAULT_TRACE_FILE = None
+DEFAULT_ADAPTIVE_DEADBAND = 1.0
+DEFAULT_ADAPTIVE_THRESHOLD = 3.0
+DEFAULT_EVENTS = "no"
+DEFAULT_EVENT_BAND = 2.0
+DEFAULT_ENGINE = "thread"
+DEFAULT_CALIBRATION_FILE = None
+
+## Devices
+DEFAULT_DEVICE = None
 
 ## Sensors
 DEFAULT_SENSOR_DIVISOR = 1000
 DEFAULT_SENSOR_OFFSET = 0
+DEFAULT_SENSOR_TIMEOUT = 0.25
+DEFAULT_SENSOR_FILTER = "none"
+DEFAULT_SENSOR_FILTER_WINDOW = 5
+DEFAULT_SENSOR_FILTER_ALPHA = 0.3
 
 ## Fans
 DEFAULT_FAN_MIN_CONTROL_VALUE = 0
 DEFAULT_FAN_MAX_CONTROL_VALUE = 255
 DEFAULT_FAN_ALLOW_SHUTOFF = "no"
 DEFAULT_FAN_MINIMUM_DUTY_CYCLE = 30
+DEFAULT_FAN_INTERPOLATION = "linear"
+DEFAULT_FAN_CURVE_RESOLUTION = 0
+DEFAULT_FAN_CONTROL_CHECK_INTERVAL = 10.0
+DEFAULT_FAN_HYSTERESIS = 0
+DEFAULT_FAN_MAX_STEP_PER_SECOND = 0
+DEFAULT_FAN_STALL_CHECK_INTERVAL = 30.0
+DEFAULT_FAN_MODE = "curve"
+DEFAULT_FAN_PID_KP = 4.0
+DEFAULT_FAN_PID_KI = 0.2
+DEFAULT_FAN_PID_KD = 0.0
+DEFAULT_FAN_PID_DEADBAND = 0
+
+# Version of the configuration cache layout, bump when it changes
+CACHE_FORMAT = 1
+
+
+def _code_stamp() -> tuple:
+    """Identify the code that filled defaults and compiled curves, so caches
+    written by other versions are not used. Contents are checked, not
+    modification times, which packaging may pin
+    """
+    package = os.path.dirname(__file__)
+    return (CACHE_FORMAT,
+            _checksum(os.path.join(package, "config.py")),
+            _checksum(os.path.join(package, "fan.py")))
+
+
+def _checksum(file_path: str) -> int:
+    """Checksum of the contents of a file"""
+    with open(file_path, 'rb') as file:
+        return zlib.crc32(file.read())
 
 
 class Config:
     """Class to manage configuration files"""
 
     config: dict
+    cache_dir: str
+    curves: list[Interpolator]
 
-    def __init__(self, file_path: str, auto_load: bool = False):
+    def __init__(self, file_path: str, auto_load: bool = False, cache_dir: str = None):
         self.file_path = file_path
         self.config = None
+        self.cache_dir = cache_dir
+        self.curves = None
         if auto_load:
             self._read_configuration()
 
@@ -48,20 +108,97 @@ class Config:
         """Users should not call this function directly, would be called when
         config is needed
         """
+        if self.cache_dir is not None and self._load_cache():
+            return
+
+        # Only needed when there is no usable cache, it takes a while to load
+        import yaml
         with open(self.file_path, 'r', encoding='utf-8') as file:
             self.config = yaml.safe_load(file)
+        self._set_defaults()
+        if self.cache_dir is not None:
+            self._write_cache()
 
+    def _set_defaults(self) -> None:
+        """Fill the configuration with default values"""
         # Set default values if not configured
         if "INTERVAL" not in self.config:
             self.config["INTERVAL"] = DEFAULT_INTERVAL
+        if "SAMPLING" not in self.config:
+            self.config["SAMPLING"] = DEFAULT_SAMPLING
+        if "SAMPLING_WORKERS" not in self.config:
+            self.config["SAMPLING_WORKERS"] = DEFAULT_SAMPLING_WORKERS
+        if "STATS_INTERVAL" not in self.config:
+            self.config["STATS_INTERVAL"] = DEFAULT_STATS_INTERVAL
+        if "METRICS_SOCKET" not in self.config:
+            self.config["METRICS_SOCKET"] = DEFAULT_METRICS_SOCKET
+        if "METRICS_TEXTFILE" not in self.config:
+            self.config["METRICS_TEXTFILE"] = DEFAULT_METRICS_TEXTFILE
+        if "METRICS_TEXTFILE_INTERVAL" not in self.config:
+            self.config["METRICS_TEXTFILE_INTERVAL"] = DEFAULT_METRICS_TEXTFILE_INTERVAL
+        if "TRACE_FILE" not in self.config:
+            self.config["TRACE_FILE"] = DEFAULT_TRACE_FILE
+        if "ADAPTIVE_MAX_INTERVAL" not in self.config:
+            self.config["ADAPTIVE_MAX_INTERVAL"] = DEFAULT_ADAPTIVE_MAX_INTERVAL
+        if "ADAPTIVE_DEADBAND" not in self.config:
+            self.config["ADAPTIVE_DEADBAND"] = DEFAULT_ADAPTIVE_DEADBAND
+        if "ADAPTIVE_THRESHOLD" not in self.config:
+            self.config["ADAPTIVE_THRESHOLD"] = DEFAULT_ADAPTIVE_THRESHOLD
+        if "EVENTS" not in self.config:
+            self.config["EVENTS"] = DEFAULT_EVENTS
+        if "EVENT_BAND" not in self.config:
+            self.config["EVENT_BAND"] = DEFAULT_EVENT_BAND
+        if "ENGINE" not in self.config:
+            self.config["ENGINE"] = DEFAULT_ENGINE
+        if "CALIBRATION_FILE" not in self.config:
+            self.config["CALIBRATION_FILE"] = DEFAULT_CALIBRATION_FILE
+        if "FANS" not in self.config:
+            self.config["FANS"] = []
+        if "ZONES" not in self.config:
+            self.config["ZONES"] = []
+
+        for zone in self.get_zones_config():
+            if "interval" not in zone:
+                zone["interval"] = self.config["INTERVAL"]
+
+        # Zone fans are only updated on new samples, so sensors are read as
+        # often as the fastest zone using them. Top level FANS run at INTERVAL
+        zone_intervals = {}
+        if self.config["ENGINE"] == "asyncio":
+            zones = [(self.config["INTERVAL"], self.get_fans_config())]
+            zones += [(zone["interval"], zone["fans"]) for zone in self.get_zones_config()]
+            for interval, fans in zones:
+                for fan in fans:
+                    for sensor in fan["sensors"]:
+                        name = sensor["name"]
+                        zone_intervals[name] = min(zone_intervals.get(name, interval), interval)
 
         for sensor in self.get_sensors_config():
             if "divisor" not in sensor:
                 sensor["divisor"] = DEFAULT_SENSOR_DIVISOR
             if "offset" not in sensor:
                 sensor["offset"] = DEFAULT_SENSOR_OFFSET
+            if "device" not in sensor:
+                sensor["device"] = DEFAULT_DEVICE
+            if "interval" not in sensor:
+                sensor["interval"] = zone_intervals.get(sensor["name"], self.config["INTERVAL"])
+            if "timeout" not in sensor:
+                sensor["timeout"] = DEFAULT_SENSOR_TIMEOUT
+            if "filter" not in sensor:
+                sensor["filter"] = DEFAULT_SENSOR_FILTER
+            if "filter_window" not in sensor:
+                sensor["filter_window"] = DEFAULT_SENSOR_FILTER_WINDOW
+            if "filter_alpha" not in sensor:
+                sensor["filter_alpha"] = DEFAULT_SENSOR_FILTER_ALPHA
 
-        for fan in self.get_fans_config():
+        fans = [(fan, self.config["INTERVAL"]) for fan in self.get_fans_config()]
+        for zone in self.get_zones_config():
+            fans += [(fan, zone["interval"]) for fan in zone["fans"]]
+        for fan, interval in fans:
+            if "device" not in fan:
+                fan["device"] = DEFAULT_DEVICE
+            if "interval" not in fan:
+                fan["interval"] = interval
             if "max_control_value" not in fan:
                 fan["max_control_value"] = DEFAULT_FAN_MAX_CONTROL_VALUE
             if "min_control_value" not in fan:
@@ -70,6 +207,89 @@ class Config:
                 fan["allow_shutoff"] = DEFAULT_FAN_ALLOW_SHUTOFF
             if "minimum_duty_cycle" not in fan:
                 fan["minimum_duty_cycle"] = DEFAULT_FAN_MINIMUM_DUTY_CYCLE
+            if "interpolation" not in fan:
+                fan["interpolation"] = DEFAULT_FAN_INTERPOLATION
+            if "curve_resolution" not in fan:
+                fan["curve_resolution"] = DEFAULT_FAN_CURVE_RESOLUTION
+            if "control_check_interval" not in fan:
+                fan["control_check_interval"] = DEFAULT_FAN_CONTROL_CHECK_INTERVAL
+            if "hysteresis" not in fan:
+                fan["hysteresis"] = DEFAULT_FAN_HYSTERESIS
+            if "max_step_per_second" not in fan:
+                fan["max_step_per_second"] = DEFAULT_FAN_MAX_STEP_PER_SECOND
+            if "stall_check_interval" not in fan:
+                fan["stall_check_interval"] = DEFAULT_FAN_STALL_CHECK_INTERVAL
+            if "mode" not in fan:
+                fan["mode"] = DEFAULT_FAN_MODE
+            if "pid_kp" not in fan:
+                fan["pid_kp"] = DEFAULT_FAN_PID_KP
+            if "pid_ki" not in fan:
+                fan["pid_ki"] = DEFAULT_FAN_PID_KI
+            if "pid_kd" not in fan:
+                fan["pid_kd"] = DEFAULT_FAN_PID_KD
+            if "pid_deadband" not in fan:
+                fan["pid_deadband"] = DEFAULT_FAN_PID_DEADBAND
+
+    def _cache_path(self) -> str:
+        """Path of the cache of this configuration file"""
+        name = "%08x" % zlib.crc32(os.path.abspath(self.file_path).encode())
+        return os.path.join(self.cache_dir, f"config-{name}.cache")
+
+    def _load_cache(self) -> bool:
+        """Load the configuration and its compiled curves from the cache if it
+        was written from the current file by this version. The file is only
+        read to compare its checksum when its modification time changed.
+        Returns False if there is no usable cache
+        """
+        try:
+            stat = os.stat(self.file_path)
+            with open(self._cache_path(), 'rb') as file:
+                stamp, size, mtime, checksum, conf, curves = marshal.load(file)
+            if stamp != _code_stamp() or size != stat.st_size:
+                return False
+            if mtime != stat.st_mtime_ns and checksum != _checksum(self.file_path):
+                return False
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        self.config = conf
+        self.curves = load_curves(curves)
+        logging.debug("Configuration loaded from cache %s", self._cache_path())
+        if mtime != stat.st_mtime_ns:
+            self._write_cache()
+        return True
+
+    def _write_cache(self) -> None:
+        """Compile the curves of every fan and store them with the
+        configuration. Nothing is cached if a curve is not valid, the error
+        is reported when creating the fan
+        """
+        try:
+            curves = []
+            zone_fans = [fan for zone in self.get_zones_config() for fan in zone["fans"]]
+            for fan in self.get_fans_config() + zone_fans:
+                if fan["interpolation"] not in INTERPOLATORS or fan["mode"] != "curve":
+                    continue
+                for sensor in fan["sensors"]:
+                    curves.append(intern_curve(fan["interpolation"],
+                                               sensor["curve"],
+                                               fan["curve_resolution"]
+                                               ))
+            self.curves = curves
+            stat = os.stat(self.file_path)
+            data = marshal.dumps((_code_stamp(),
+                                  stat.st_size,
+                                  stat.st_mtime_ns,
+                                  _checksum(self.file_path),
+                                  self.config,
+                                  dump_curves(curves)
+                                  ))
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._cache_path()
+            with open(path + ".tmp", 'wb') as file:
+                file.write(data)
+            os.replace(path + ".tmp", path)
+        except (OSError, ValueError, KeyError, TypeError) as exp:
+            logging.warning("Could not write configuration cache: %s", exp)
 
     def get_full_config(self) -> dict:
         """Get entire read dictionary, used for debug, mostly"""
@@ -96,9 +316,94 @@ class Config:
             if (sensor_idx is not None) else \
             self.config["SENSORS"]
 
+    def get_zones_config(self) -> list[dict]:
+        """Returns the list of cooling zones, each with its own name, interval
+        and fans
+        """
+        if not self.config:
+            self._read_configuration()
+
+        return self.config["ZONES"]
+
+    def get_engine(self) -> str:
+        """Returns the engine to run the control loop with"""
+        if not self.config:
+            self._read_configuration()
+
+        return self.config["ENGINE"]
+
     def get_interval(self) -> float:
         """Returns interval data from configuration"""
         if not self.config:
             self._read_configuration()
 
         return self.config["INTERVAL"]
+
+    def get_stats_interval(self) -> float:
+        """Returns the interval to log loop statistics at"""
+        if not self.config:
+            self._read_configuration()
+
+        return self.config["STATS_INTERVAL"]
+
+    def get_trace_file(self) -> str:
+        """Returns the path of the file to record a trace of the loop to"""
+        if not self.config:
+            self._read_configuration()
+
+        return self.config["TRACE_FILE"]
+
+    def get_calibration_file(self) -> str:
+        """Returns the path of the file storing fan calibrations"""
+        if not self.config:
+            self._read_configuration()
+
+        return self.config["CALIBRATION_FILE"]
+
+    def get_sampling(self) -> str:
+        """Returns the sampling engine to read sensors with"""
+        if not self.config:
+            self._read_configuration()
+
+        return self.config["SAMPLING"]
+
+    def get_sampling_workers(self) -> int:
+        """Returns the number of threads for concurrent sampling"""
+        if not self.config:
+            self._read_configuration()
+
+        return self.config["SAMPLING_WORKERS"]
+
+    def get_adaptive_config(self) -> dict:
+        """Returns adaptive interval configuration. Adaptive polling is
+        disabled if the max interval is not greater than the interval
+        """
+        if not self.config:
+            self._read_configuration()
+
+        return {
+            "max_interval": self.config["ADAPTIVE_MAX_INTERVAL"],
+            "deadband": self.config["ADAPTIVE_DEADBAND"],
+            "threshold": self.config["ADAPTIVE_THRESHOLD"],
+        }
+
+    def get_events_config(self) -> dict:
+        """Returns sensor alarm configuration"""
+        if not self.config:
+            self._read_configuration()
+
+        return {
+            "events": self.config["EVENTS"] == "yes",
+            "event_band": self.config["EVENT_BAND"],
+        }
+
+    def get_metrics_config(self) -> dict:
+        """Returns metrics export configuration"""
+        if not self.config:
+            self._read_configuration()
+
+        return {
+            "socket_path": self.config["METRICS_SOCKET"],
+            "textfile_path": self.config["METRICS_TEXTFILE"],
+            "textfile_interval": self.config["METRICS_TEXTFILE_INTERVAL"],
+        }
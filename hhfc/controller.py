@@ -16,10 +16,45 @@ A PARTICULAR PURPOSE. See the GNU General Public License for more details.
 with hhfc. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import heapq
+import math
+import os
+import select
 import threading
+import time
 import logging
-from hhfc.fan import Fan
+from typing import TYPE_CHECKING
+from hhfc import hwmon, util
+from hhfc.config import Config
+from hhfc.fan import Fan, Interpolator
+from hhfc.pid import PidController
 from hhfc.sensor import Sensor
+from hhfc.sampler import Sampler, ConcurrentSampler
+from hhfc.adaptive import IntervalAdapter
+from hhfc.stats import LoopStats
+from hhfc.events import SensorAlarm, ALARM_EVENTS
+from hhfc.calibrate import apply_calibrations
+
+if TYPE_CHECKING:
+    # Only imported when TRACE_FILE is set, see __main__
+    from hhfc.trace import TraceWriter
+
+# Kinds of tasks in the schedule. Sensors go first when due at the same time
+SENSOR_TASK = 0
+FAN_TASK = 1
+
+# Seconds the boot time clock has to get ahead of the monotonic clock, that
+# stops while suspended, to consider the system resumed from suspend
+RESUME_CLOCK_JUMP = 1.0
+
+# Longest single sleep of the loop. Sleep timeouts run on the monotonic clock
+# too, so longer waits are cut to notice a resume soon after it happens
+RESUME_CHECK_INTERVAL = 1.0
+
+
+def _suspended_time() -> float:
+    """Returns the total time the system spent suspended since boot"""
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - time.monotonic()
 
 
 class Controller:
@@ -29,53 +64,826 @@ class Controller:
     sensors: list[Sensor]
     loop_interval: float
     monitor: bool
+    sampler: Sampler
+    sensors_by_name: dict[str, Sensor]
+    sensor_values: list[float]
+    sensor_raw_values: list[float]
+    bindings: list[tuple[int, Interpolator]]
+    fan_plans: list[tuple[tuple[int, int], ...]]
+    fan_pids: list[tuple[PidController, ...]]
+    schedule: list[list]
+    fan_samples: list[int]
+    fan_inputs: list[list[float]]
+    fan_target: list[float]
+    fan_level: list[float]
+    fan_updated: list[float]
+    fan_duty: list[int]
+    adapter: IntervalAdapter
+    stats: LoopStats
+    stats_interval: float
+    recorder: "TraceWriter"
+    events: bool
+    event_band: float
+    alarms: dict[Sensor, SensorAlarm]
+    rpm_wanted_until: float
+    pending: "Controller"
+    pending_lock: threading.RLock
+    resume_pending: bool
     exit_loop: threading.Event
 
-    def __init__(self, fans: list[Fan], sensors: list[Sensor], loop_interval: float, monitor=False):
+    def __init__(self,
+                 fans: list[Fan],
+                 sensors: list[Sensor],
+                 loop_interval: float,
+                 monitor=False,
+                 sampler: Sampler = None,
+                 adapter: IntervalAdapter = None,
+                 stats_interval: float = 0,
+                 recorder: "TraceWriter" = None,
+                 events: bool = False,
+                 event_band: float = 2.0
+                 ):
         self.fans = fans
         self.sensors = sensors
         self.loop_interval = loop_interval
         self.monitor = monitor
+        self.sampler = sampler if sampler is not None else Sampler()
+        self.sensors_by_name = {sensor.name: sensor for sensor in sensors}
+        self.sensor_values = [None] * len(sensors)
+        self.sensor_raw_values = [None] * len(sensors)
+        self.bindings = []
+        self.fan_plans = [self._compile_plan(fan) for fan in fans]
+        self.fan_pids = [
+            tuple(fan.pids[sensors[sensor_idx].name] for sensor_idx, _ in plan) if fan.pids else ()
+            for fan, plan in zip(fans, self.fan_plans)
+        ]
+        self.binding_inputs = [None] * len(self.bindings)
+        self.binding_values = [None] * len(self.bindings)
+        logging.debug("%i sensor curves, %i distinct",
+                      sum(len(plan) for plan in self.fan_plans),
+                      len(self.bindings)
+                      )
+        self.schedule = []
+        self._due_sensors = []
+        self._due_fans = []
+        self.fan_samples = [-1] * len(fans)
+        self.fan_inputs = [[None] * len(plan) for plan in self.fan_plans]
+        self.fan_target = [None] * len(fans)
+        self.fan_level = [None] * len(fans)
+        self.fan_updated = [None] * len(fans)
+        self.fan_duty = [None] * len(fans)
+        self.adapter = adapter
+        self.stats = LoopStats([sensor.name for sensor in sensors], [fan.name for fan in fans])
+        self.stats_interval = stats_interval
+        self.recorder = recorder
+        self.events = events
+        self.event_band = event_band
+        self.alarms = {}
+        self._alarm_fds = {}
+        self._alarmed = set()
+        self._poller = None
+        self._wake_fds = None
+        self.first_write = None
+        self.rpm_wanted_until = 0.0
+        self.pending = None
+        # Reentrant, reload runs in a signal handler that may interrupt itself
+        self.pending_lock = threading.RLock()
+        self.resume_pending = False
         self.exit_loop = threading.Event()
 
-    def _loop_iter(self) -> None:
-        sensor_readings = {}
-        for sensor in self.sensors:
-            sensor_readings[sensor.name] = sensor.read_input()
+    def _compile_plan(self, fan: Fan) -> tuple[tuple[int, int], ...]:
+        """Bind each sensor of a fan to its index in the sensor list and the
+        index of the (sensor, curve) pair in the bindings list. Fans with the
+        same curve for a sensor share the binding, so it is evaluated once.
+        Fans in PID mode have no curves, their binding index is None
+        """
+        sensor_idx = {sensor.name: idx for idx, sensor in enumerate(self.sensors)}
+        plan = []
+        for sensor_conf in fan.sensors:
+            name = sensor_conf["name"]
+            if name not in sensor_idx:
+                logging.warning("Sensor '%s' of fan '%s' is not defined", name, fan.name)
+                continue
+            if fan.pids:
+                plan.append((sensor_idx[name], None))
+                continue
+            binding = (sensor_idx[name], fan.interpolator[name])
+            for binding_idx, other in enumerate(self.bindings):
+                if other[0] == binding[0] and other[1] is binding[1]:
+                    break
+            else:
+                binding_idx = len(self.bindings)
+                self.bindings.append(binding)
+            plan.append((sensor_idx[name], binding_idx))
+        return tuple(plan)
 
-        if self.monitor:
-            logging.info("Sensor readings: %s", str(sensor_readings))
-        else:
-            logging.debug("Sensor readings: %s", str(sensor_readings))
+    def _schedule(self, start: float) -> None:
+        """Build the schedule with every sensor and fan due at `start`.
+        Entries are lists so they can be reused when rescheduled
+        """
+        self.schedule = []
+        for idx in range(len(self.sensors)):
+            heapq.heappush(self.schedule, [start, SENSOR_TASK, idx])
+        for idx in range(len(self.fans)):
+            heapq.heappush(self.schedule, [start, FAN_TASK, idx])
 
-        for fan in self.fans:
-            fan_duty = []
-            for sensor in fan.sensors:
-                if sensor["name"] in sensor_readings:
-                    name = sensor["name"]
-                    fan_duty.append(fan.get_desired_duty_cycle(name, sensor_readings[name]))
-                else:
-                    logging.warning("Sensor '%s' has no value for fan '%s'",
-                                    sensor['name'],
-                                    fan.name
-                                    )
-            if not self.monitor:
-                logging.debug("fan %s: setting duty cycle to %s", fan.name, int(max(fan_duty)))
-                fan.set_duty_cycle(int(max(fan_duty)))
-                logging.debug("fan %s: %s RPM", fan.name, fan.read_input())
+    def _snap_schedule(self, now: float) -> None:
+        """Bring every task back to at most its base interval from `now`"""
+        for entry in self.schedule:
+            entry[0] = min(entry[0], now + self._base_interval(entry[1], entry[2]))
+        heapq.heapify(self.schedule)
+
+    def _base_interval(self, kind: int, idx: int) -> float:
+        """Returns the configured interval of a task"""
+        device = self.sensors[idx] if kind == SENSOR_TASK else self.fans[idx]
+        return device.interval if device.interval else self.loop_interval
+
+    def get_effective_interval(self) -> float:
+        """Returns the current interval of the control loop"""
+        if self.adapter is None:
+            return self.loop_interval
+        return self.adapter.scale_interval(self.loop_interval)
+
+    def _pop_due(self, now: float) -> None:
+        """Move the sensors and the indexes of the fans due at `now` from the
+        schedule to the due lists and schedule their next run
+        """
+        schedule = self.schedule
+        due_sensors = self._due_sensors
+        due_fans = self._due_fans
+        due_sensors.clear()
+        due_fans.clear()
+        while schedule and schedule[0][0] <= now:
+            entry = heapq.heappop(schedule)
+            due, kind, idx = entry
+            if kind == SENSOR_TASK:
+                due_sensors.append(self.sensors[idx])
             else:
-                logging.info("fan %s: %s RPM (%i)",
-                             fan.name,
-                             fan.read_input(),
-                             int(max(fan_duty))
-                             )
+                due_fans.append(idx)
+            interval = self._base_interval(kind, idx)
+            if self.adapter is not None:
+                interval = self.adapter.scale_interval(interval)
+            next_due = due + interval
+            if next_due <= now:
+                # Overrun: skip the missed deadlines instead of running them
+                # back to back
+                missed = int((now - due) // interval)
+                self.stats.missed_deadlines += missed
+                next_due = due + (missed + 1) * interval
+                logging.debug("Overrun: %i deadlines missed", missed)
+            entry[0] = next_due
+            heapq.heappush(schedule, entry)
+
+    def _loop_iter(self, now: float = None) -> float:
+        """Service the sensors and fans due at `now` and return the time the
+        next one is due
+        """
+        if now is None:
+            now = time.monotonic()
+        self._start_iter(now)
+        if self._due_sensors:
+            self.sampler.sample(self._due_sensors)
+        return self._finish_iter(now)
+
+    def _start_iter(self, now: float) -> None:
+        """Collect the sensors and fans due at `now`. The due sensors have to
+        be sampled before calling `_finish_iter`
+        """
+        if not self.schedule:
+            self._schedule(now)
+        self._pop_due(now)
+
+    def _finish_iter(self, now: float) -> float:
+        """Update the fans due at `now` with the new sensor samples and return
+        the time the next task is due
+        """
+        due_sensors = self._due_sensors
+
+        if due_sensors:
+            sensor_read = self.stats.sensor_read
+            for sensor in due_sensors:
+                if sensor.timestamp is not None and sensor.timestamp >= now:
+                    sensor_read[sensor.name].add(sensor.latency)
+            self._store_values()
+            if self.alarms:
+                self._program_alarms(due_sensors)
+            level = logging.INFO if self.monitor else logging.DEBUG
+            if logging.getLogger().isEnabledFor(level):
+                sensor_readings = {
+                    sensor.name: sensor.value if sensor.filter is None else
+                    f"{sensor.value:.1f} (raw {sensor.raw_value})"
+                    for sensor in due_sensors if sensor.value is not None
+                }
+                logging.log(level, "Sensor readings: %s", sensor_readings)
+
+        duty_changed = False
+        fans = self.fans
+        for fan_idx in self._due_fans:
+            duty_changed |= self._update_fan(fan_idx, fans[fan_idx], now)
+        if self._due_fans:
+            self._sample_rpm(now)
+
+        if self.adapter is not None:
+            self.adapter.wakeup(now)
+            if self.adapter.update(due_sensors, duty_changed, self.loop_interval):
+                self._snap_schedule(now)
+
+        if self.recorder is not None:
+            # Unfiltered, so replays can try other filters
+            self.recorder.record(time.time(), self.sensor_raw_values, self.fans, self.fan_duty)
+
+        return self.schedule[0][0]
+
+    def _store_values(self) -> None:
+        """Copy the last good value of every sensor to the values arrays"""
+        values = self.sensor_values
+        raw_values = self.sensor_raw_values
+        for idx, sensor in enumerate(self.sensors):
+            values[idx] = sensor.value
+            raw_values[idx] = sensor.raw_value
+
+    def _update_fan(self, fan_idx: int, fan: Fan, now: float) -> bool:
+        """Compute and set the duty cycle of a fan if any of its sensors has
+        a new sample since the last update, or if it is still ramping towards
+        its target. Returns True if the duty cycle changed
+        """
+        plan = self.fan_plans[fan_idx]
+        sensors = self.sensors
+        last_update, self.fan_updated[fan_idx] = self.fan_updated[fan_idx], now
+        samples = 0
+        for sensor_idx, _ in plan:
+            samples += sensors[sensor_idx].samples
+        if samples != self.fan_samples[fan_idx]:
+            self.fan_samples[fan_idx] = samples
+            if self.fan_pids[fan_idx]:
+                target = self._compute_pid_target(fan_idx, fan, now)
+            else:
+                target = self._compute_target(fan_idx, fan)
+            if target is None:
+                return False
+            self.fan_target[fan_idx] = target
+        elif self.fan_level[fan_idx] == self.fan_target[fan_idx]:
+            return False
+
+        level = self.fan_target[fan_idx]
+        last_level = self.fan_level[fan_idx]
+        if fan.max_step_per_second and last_level is not None and last_update is not None:
+            if last_level <= fan.min_allowed < level:
+                # Levels up to the minimum would run the fan at the minimum
+                # or keep it off, ramp up from where it starts spinning
+                last_level = fan.min_allowed
+            step = fan.max_step_per_second * (now - last_update)
+            level = min(max(level, last_level - step), last_level + step)
+        self.fan_level[fan_idx] = level
+        # What the fan is actually set to, after the shutoff and minimum policy
+        duty = int(fan.limit_duty_cycle(int(level)))
+        if not self.monitor:
+            writes = fan.writes_issued
+            start = time.monotonic()
+            fan.set_duty_cycle(duty)
+            if fan.writes_issued != writes:
+                self.stats.fan_write[fan.name].add(time.monotonic() - start)
+                if self.first_write is None:
+                    self._log_first_write()
+            logging.debug("fan %s: setting duty cycle to %s", fan.name, duty)
+        else:
+            logging.info("fan %s: duty cycle %i", fan.name, duty)
+        changed = duty != self.fan_duty[fan_idx]
+        self.fan_duty[fan_idx] = duty
+        return changed
+
+    def _sample_rpm(self, now: float) -> None:
+        """Read the speed of the fans due at `now`, only if something needs
+        it: a metrics consumer, the DEBUG log level or a due stall check
+        """
+        fans = self.fans
+        wanted = self.rpm_wanted_until > time.monotonic()
+        if wanted or logging.getLogger().isEnabledFor(logging.DEBUG):
+            for fan_idx in self._due_fans:
+                fan = fans[fan_idx]
+                try:
+                    logging.debug("fan %s: %s RPM", fan.name, fan.read_input())
+                except OSError as err:
+                    logging.debug("fan %s: could not read speed: %s", fan.name, err)
+        if self.monitor:
+            return
+        for fan_idx in self._due_fans:
+            fan = fans[fan_idx]
+            if fan.stall_check_due(now):
+                try:
+                    fan.check_stall(now)
+                except OSError as err:
+                    logging.warning("fan %s: could not read speed: %s", fan.name, err)
+
+    def request_rpm(self, duration: float) -> None:
+        """Ask for fan speeds to be read during the next `duration` seconds.
+        Safe to call from other threads
+        """
+        self.rpm_wanted_until = max(self.rpm_wanted_until, time.monotonic() + duration)
+
+    def _log_first_write(self) -> None:
+        """Record and report how long it took from process start to the
+        first fan write
+        """
+        age = util.process_age()
+        self.first_write = age if age is not None else math.nan
+        if age is not None:
+            logging.debug("First fan write %.0fms after process start", age * 1000)
+
+    def _compute_target(self, fan_idx: int, fan: Fan) -> float:
+        """Returns the duty cycle the curves of a fan ask for with the latest
+        sensor values, the highest of all its sensors. With hysteresis a
+        reading has to drop more than `hysteresis` degrees below the one last
+        used before the duty cycle follows it down, rises are followed at
+        once. Returns None if no sensor has a value yet
+        """
+        values = self.sensor_values
+        inputs = self.binding_inputs
+        results = self.binding_values
+        held = self.fan_inputs[fan_idx]
+        hysteresis = fan.hysteresis
+        duty = None
+        for plan_idx, (sensor_idx, binding_idx) in enumerate(self.fan_plans[fan_idx]):
+            value = values[sensor_idx]
+            if value is None:
+                logging.warning("Sensor '%s' has no value for fan '%s'",
+                                self.sensors[sensor_idx].name,
+                                fan.name
+                                )
+                continue
+            if hysteresis:
+                last = held[plan_idx]
+                if last is not None:
+                    value = min(max(last, value), value + hysteresis)
+                held[plan_idx] = value
+            if inputs[binding_idx] != value:
+                # Only evaluated once per new reading for all fans sharing it
+                results[binding_idx] = self.bindings[binding_idx][1].get_value(value)
+                inputs[binding_idx] = value
+            sensor_duty = fan.limit_duty_cycle(results[binding_idx])
+            if duty is None or sensor_duty > duty:
+                duty = sensor_duty
+        return duty
+
+    def _compute_pid_target(self, fan_idx: int, fan: Fan, now: float) -> float:
+        """Returns the duty cycle the PID controllers of a fan ask for with
+        the latest sensor values, the highest of all its sensors. Returns
+        None if no sensor has a value yet
+        """
+        values = self.sensor_values
+        duty = None
+        for (sensor_idx, _), pid in zip(self.fan_plans[fan_idx], self.fan_pids[fan_idx]):
+            value = values[sensor_idx]
+            if value is None:
+                logging.warning("Sensor '%s' has no value for fan '%s'",
+                                self.sensors[sensor_idx].name,
+                                fan.name
+                                )
+                continue
+            sensor_duty = pid.update(value, now)
+            if duty is None or sensor_duty > duty:
+                duty = sensor_duty
+        return duty
 
     def _loop(self) -> None:
-        """Main control loop"""
+        """Main control loop. Waits until absolute deadlines so the time
+        spent on each iteration does not add up to the interval
+        """
+        self._open_wakeup()
+        try:
+            if self.events:
+                self._setup_events()
+            next_report = time.monotonic() + self.stats_interval
+            suspended = _suspended_time()
+            while True:
+                if self.pending is not None:
+                    self._apply_reload()
+                last_suspended, suspended = suspended, _suspended_time()
+                if suspended - last_suspended > RESUME_CLOCK_JUMP:
+                    logging.info("Resumed after %.0fs suspended", suspended - last_suspended)
+                    self.resume_pending = True
+                if self.resume_pending:
+                    self._resume()
+                start = time.monotonic()
+                if self._alarmed:
+                    self._expedite(start)
+                next_due = self._loop_iter(start)
+                end = time.monotonic()
+                self.stats.tick.add(end - start)
+
+                if self.stats_interval and end >= next_report:
+                    self._log_stats()
+                    next_report = end + self.stats_interval
+
+                if self._wait(max(next_due - end, 0)):
+                    return
+        finally:
+            self._teardown_events()
+            self._close_wakeup()
+
+    def _resume(self) -> None:
+        """Restore control after a suspend: look up hwmon devices again, open
+        their attributes, take control of the fans if the firmware took it
+        back and write the last duty cycles again. If devices are not back
+        yet it is tried again on the next iteration
+        """
+        try:
+            hwmon.index.rebuild()
+            for device in self.fans + self.sensors:
+                device.device.refresh()
+                device.close()
+        except (OSError, RuntimeError) as exp:
+            logging.warning("Devices not ready after resume: %s", exp)
+            return
+
+        self.schedule = []
+        if self.adapter is not None:
+            self.adapter.reset()
+        for sensor in self.sensors:
+            sensor.reset_filter()
+        # Time suspended is not time the error lasted
+        for pids in self.fan_pids:
+            for pid in pids:
+                pid.reset()
+
+        if not self.monitor:
+            for fan, duty in zip(self.fans, self.fan_duty):
+                try:
+                    if not fan.check_control():
+                        logging.info("Taking control of fan again: %s", fan.name)
+                        fan.take_control()
+                    fan.invalidate_control()
+                    if duty is not None:
+                        fan.set_duty_cycle(duty)
+                except OSError as exp:
+                    logging.warning("Could not restore fan %s after resume: %s", fan.name, exp)
+                    return
+        if self.events:
+            self._setup_events()
+        self.resume_pending = False
+
+    def _open_wakeup(self) -> None:
+        """Create the poller the loop sleeps on and the pipe used to wake it
+        up from other threads
+        """
+        self._poller = select.poll()
+        self._wake_fds = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._poller.register(self._wake_fds[0], select.POLLIN)
+
+    def _close_wakeup(self) -> None:
+        """Close the wake up pipe"""
+        wake_fds, self._wake_fds = self._wake_fds, None
+        self._poller = None
+        if wake_fds is not None:
+            for fd in wake_fds:
+                os.close(fd)
+
+    def _wait(self, timeout: float) -> bool:
+        """Sleep for `timeout` seconds, until woken up, until a sensor raises
+        an alarm or until the system resumes from suspend. Returns True if
+        the loop has to exit
+        """
+        deadline = time.monotonic() + timeout
+        suspended = _suspended_time()
         while True:
-            self._loop_iter()
-            if self.exit_loop.wait(timeout=self.loop_interval):
-                return
+            timeout = min(max(deadline - time.monotonic(), 0), RESUME_CHECK_INTERVAL)
+            # Round up, waking up early just to find nothing due is a wasted tick
+            events = self._poller.poll(math.ceil(timeout * 1000))
+            for fd, event in events:
+                if fd == self._wake_fds[0]:
+                    try:
+                        while os.read(fd, 64):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._on_alarm(fd, event)
+            if events or time.monotonic() >= deadline:
+                break
+            if _suspended_time() - suspended > RESUME_CLOCK_JUMP:
+                break
+        return self.exit_loop.is_set()
+
+    def wake(self) -> None:
+        """Wake the control loop up if it is sleeping"""
+        wake_fds = self._wake_fds
+        if wake_fds is None:
+            return
+        try:
+            os.write(wake_fds[1], b"\0")
+        except OSError:
+            # Pipe full, the loop is being woken up already, or just closed
+            pass
+
+    def stop(self) -> None:
+        """Ask the control loop to exit"""
+        self.exit_loop.set()
+        self.wake()
+
+    def _setup_events(self) -> None:
+        """Program alarm limits on the sensors whose driver supports it and
+        watch their alarm attributes. Other sensors are only polled on their
+        interval
+        """
+        self._teardown_events()
+        if self.monitor:
+            logging.info("Monitor mode, not programming sensor alarms")
+            return
+        breakpoints = [[] for _ in self.sensors]
+        for sensor_idx, curve in self.bindings:
+            breakpoints[sensor_idx].extend(curve.x_vals)
+        for idx, sensor in enumerate(self.sensors):
+            alarm = SensorAlarm(sensor, breakpoints[idx], self.event_band)
+            try:
+                supported = alarm.probe()
+            except OSError as exp:
+                logging.debug("Sensor %s: %s", sensor.name, exp)
+                supported = False
+            if not supported:
+                logging.info("Sensor %s has no usable alarms, polling every %.2fs",
+                             sensor.name,
+                             self._base_interval(SENSOR_TASK, idx)
+                             )
+                alarm.restore()
+                continue
+            logging.info("Sensor %s: waiting for alarms on %s",
+                         sensor.name,
+                         ", ".join(attribute.name for attribute in alarm.alarms)
+                         )
+            self.alarms[sensor] = alarm
+            self._watch_alarm(idx, alarm)
+            self._program_alarms([sensor])
+
+    def _watch_alarm(self, sensor_idx: int, alarm: SensorAlarm) -> None:
+        """Add the alarm attributes of a sensor to the poller"""
+        for fd in alarm.fds():
+            self._alarm_fds[fd] = sensor_idx
+            self._poller.register(fd, ALARM_EVENTS)
+
+    def _unwatch_alarm(self, alarm: SensorAlarm) -> None:
+        """Remove the alarm attributes of a sensor from the poller"""
+        for fd in [fd for fd, idx in self._alarm_fds.items()
+                   if self.alarms.get(self.sensors[idx]) is alarm]:
+            del self._alarm_fds[fd]
+            self._poller.unregister(fd)
+
+    def _teardown_events(self) -> None:
+        """Stop watching alarms and restore the limits of every sensor"""
+        if self._poller is not None:
+            for fd in self._alarm_fds:
+                self._poller.unregister(fd)
+        self._alarm_fds = {}
+        self._alarmed.clear()
+        for alarm in self.alarms.values():
+            alarm.restore()
+        self.alarms = {}
+
+    def _drop_alarm(self, sensor: Sensor, exp: Exception) -> None:
+        """Fall back to polling a sensor whose alarms stopped working"""
+        logging.warning("Sensor %s alarms failed, falling back to polling: %s", sensor.name, exp)
+        alarm = self.alarms[sensor]
+        self._unwatch_alarm(alarm)
+        del self.alarms[sensor]
+        alarm.restore()
+
+    def _program_alarms(self, sensors: list[Sensor]) -> None:
+        """Move the alarm limits of `sensors` around their new readings. The
+        raw readings are used, limits are compared by the hardware
+        """
+        alarms = self.alarms
+        for sensor in sensors:
+            alarm = alarms.get(sensor)
+            if alarm is None or sensor.raw_value is None:
+                continue
+            try:
+                alarm.program(sensor.raw_value)
+            except OSError as exp:
+                self._drop_alarm(sensor, exp)
+
+    def _on_alarm(self, fd: int, event: int) -> None:
+        """Handle a notification on an alarm attribute: read it to be
+        notified again and mark its sensor to be sampled right away
+        """
+        sensor_idx = self._alarm_fds.get(fd)
+        if sensor_idx is None:
+            return
+        sensor = self.sensors[sensor_idx]
+        alarm = self.alarms[sensor]
+        fds = alarm.fds()
+        try:
+            alarm.arm()
+        except OSError as exp:
+            self._drop_alarm(sensor, exp)
+            return
+        if alarm.fds() != fds or event & select.POLLNVAL:
+            # The attributes were reopened, watch the new files
+            self._unwatch_alarm(alarm)
+            self._watch_alarm(sensor_idx, alarm)
+        self._alarmed.add(sensor_idx)
+        self.stats.alarms += 1
+        logging.debug("Sensor %s raised an alarm", sensor.name)
+
+    def _expedite(self, now: float) -> None:
+        """Make the sensors that raised an alarm, and the fans they drive,
+        due at `now`
+        """
+        alarmed = self._alarmed
+        for entry in self.schedule:
+            if entry[1] == SENSOR_TASK:
+                hit = entry[2] in alarmed
+            else:
+                hit = any(sensor_idx in alarmed for sensor_idx, _ in self.fan_plans[entry[2]])
+            if hit and entry[0] > now:
+                entry[0] = now
+        heapq.heapify(self.schedule)
+        alarmed.clear()
+
+    def reload(self, conf: Config) -> bool:
+        """Validate a new configuration and schedule it to replace the current
+        one between two loop iterations. Fans and sensors on the same hardware
+        are kept open and in control. Returns False, keeping the current
+        configuration, if the new one is not valid
+        """
+        try:
+            try:
+                new = controller_from_config(conf, self.monitor)
+            except RuntimeError:
+                # A device may have appeared since the index was built
+                hwmon.index.rebuild()
+                new = controller_from_config(conf, self.monitor)
+        except Exception as exp:
+            logging.error("Invalid configuration, keeping the current one: %s", exp)
+            return False
+        with self.pending_lock:
+            replaced, self.pending = self.pending, new
+        if replaced is not None:
+            logging.info("Replacing a reloaded configuration not applied yet")
+            replaced.sampler.shutdown()
+            replaced._close_devices()
+        self.wake()
+        return True
+
+    def _apply_reload(self) -> None:
+        """Swap in the pending configuration"""
+        with self.pending_lock:
+            new, self.pending = self.pending, None
+
+        old_fans = {fan.name: (idx, fan) for idx, fan in enumerate(self.fans)}
+        adopted = set()
+        taken = []
+        for idx, fan in enumerate(new.fans):
+            old_idx, old_fan = old_fans.get(fan.name, (None, None))
+            if old_fan is not None and fan.same_hardware(old_fan):
+                fan.adopt(old_fan)
+                new.fan_duty[idx] = self.fan_duty[old_idx]
+                new.fan_level[idx] = self.fan_level[old_idx]
+                adopted.add(old_fan.name)
+            else:
+                taken.append(fan)
+        if not self.monitor and not self._hand_over_fans(adopted, taken):
+            new.sampler.shutdown()
+            return
+
+        old_sensors = {sensor.name: sensor for sensor in self.sensors}
+        for sensor in new.sensors:
+            old_sensor = old_sensors.get(sensor.name)
+            if old_sensor is not None and sensor.same_hardware(old_sensor):
+                sensor.adopt(old_sensor)
+
+        if self.recorder is not None:
+            sensor_names = [sensor.name for sensor in new.sensors]
+            fan_names = [fan.name for fan in new.fans]
+            if (sensor_names != self.recorder.sensor_names
+                    or fan_names != self.recorder.fan_names):
+                self.recorder.restart(sensor_names, fan_names)
+
+        self._teardown_events()
+        self.sampler.shutdown()
+        self.fans = new.fans
+        self.sensors = new.sensors
+        self.loop_interval = new.loop_interval
+        self.sampler = new.sampler
+        self.sensors_by_name = new.sensors_by_name
+        self.sensor_values = new.sensor_values
+        self.sensor_raw_values = new.sensor_raw_values
+        self.bindings = new.bindings
+        self.binding_inputs = new.binding_inputs
+        self.binding_values = new.binding_values
+        self.fan_plans = new.fan_plans
+        self.fan_pids = new.fan_pids
+        self.schedule = []
+        self.fan_samples = new.fan_samples
+        self.fan_inputs = new.fan_inputs
+        self.fan_target = new.fan_target
+        self.fan_level = new.fan_level
+        self.fan_updated = new.fan_updated
+        self.fan_duty = new.fan_duty
+        self.adapter = new.adapter
+        self.stats = new.stats
+        self.stats_interval = new.stats_interval
+        self.events = new.events
+        self.event_band = new.event_band
+        if self.events:
+            self._setup_events()
+        logging.info("Configuration reloaded: %i sensors, %i fans (%i kept)",
+                     len(self.sensors),
+                     len(self.fans),
+                     len(adopted)
+                     )
+
+    def _hand_over_fans(self, adopted: set[str], taken: list[Fan]) -> bool:
+        """Release the current fans not adopted by name in `adopted`, then
+        take control of the new fans in `taken`. A fan whose enable attribute
+        is used by a new fan, renamed or with another input, is not released.
+        If a new fan can't be taken over everything is put back as it was and
+        False is returned
+        """
+        enables = {fan.pwm_enable.path for fan in taken}
+        released = []
+        for fan in self.fans:
+            if fan.name in adopted or fan.pwm_enable.path in enables:
+                continue
+            try:
+                logging.info("Release control of fan: %s", fan.name)
+                fan.release_control()
+                released.append(fan)
+            except OSError as exp:
+                logging.error("Could not release fan %s: %s", fan.name, exp)
+
+        kept = {fan.pwm_enable.path for fan in self.fans if fan not in released}
+        for idx, fan in enumerate(taken):
+            try:
+                logging.info("Taking control of fan: %s", fan.name)
+                fan.take_control()
+            except OSError as exp:
+                logging.error("Could not take control of fan %s, "
+                              "keeping the current configuration: %s",
+                              fan.name,
+                              exp
+                              )
+                for undo in taken[:idx]:
+                    if undo.pwm_enable.path not in kept:
+                        try:
+                            undo.release_control()
+                        except OSError as undo_exp:
+                            logging.error("Could not release fan %s: %s", undo.name, undo_exp)
+                for undo in released:
+                    try:
+                        undo.take_control()
+                    except OSError as undo_exp:
+                        logging.error("Could not take control of fan %s: %s", undo.name, undo_exp)
+                    undo.invalidate_control()
+                return False
+        return True
+
+    def _log_stats(self) -> None:
+        """Log loop statistics and start a new window"""
+        self.stats.log()
+        for fan in self.fans:
+            logging.info("Fan '%s': %i writes issued, %i skipped since start",
+                         fan.name,
+                         fan.writes_issued,
+                         fan.writes_skipped
+                         )
+        if self.adapter is not None:
+            logging.info("Effective interval: %.2fs, %i wakeups in the last minute",
+                         self.get_effective_interval(),
+                         self.adapter.get_wakeups_per_minute()
+                         )
+        self.stats.reset()
+
+    def get_state(self) -> dict:
+        """Returns a snapshot of the latest sensor readings, fan state and
+        loop statistics. No hwmon attribute is read, fan speeds are the last
+        read, see `request_rpm`
+        """
+        return {
+            "sensors": {
+                sensor.name: {
+                    "value": sensor.value,
+                    "raw_value": sensor.raw_value,
+                    "age": sensor.get_age() if sensor.value is not None else None,
+                } for sensor in self.sensors
+            },
+            "fans": {
+                fan.name: {
+                    "duty": duty,
+                    "pwm": fan.last_pwm,
+                    "rpm": fan.rpm,
+                    "stalled": fan.stalled,
+                    "writes_issued": fan.writes_issued,
+                    "writes_skipped": fan.writes_skipped,
+                } for fan, duty in zip(self.fans, self.fan_duty)
+            },
+            "loop": {
+                "effective_interval": self.get_effective_interval(),
+                "tick_p50": self.stats.tick.percentile(50),
+                "tick_p99": self.stats.tick.percentile(99),
+                "tick_max": self.stats.tick.maximum,
+                "missed_deadlines": self.stats.missed_deadlines,
+                "alarms": self.stats.alarms,
+            },
+        }
 
     def _take_over_fans(self):
         """Put all fans in manual mode"""
@@ -91,12 +899,24 @@ class Controller:
         """Put all fans in automatic mode"""
         for fan in self.fans:
             try:
-                logging.info("Release control of fan: %s", fan.name)
+                logging.info("Release control of fan: %s (%i writes issued, %i skipped)",
+                             fan.name,
+                             fan.writes_issued,
+                             fan.writes_skipped
+                             )
                 fan.release_control()
             except Exception as exp:
                 logging.error("Could not release fan: %s", fan.name)
                 logging.error(exp)
 
+    def _close_devices(self) -> None:
+        """Close the hwmon attributes of every fan and sensor"""
+        for device in self.fans + self.sensors:
+            try:
+                device.close()
+            except OSError as exp:
+                logging.debug("Could not close %s: %s", device.name, exp)
+
     def get_sensors_for_fan(self, fan_idx: int) -> None:
         """Get the list of sensors for given fan index"""
         return self.fans[fan_idx]["sensors"]
@@ -121,17 +941,56 @@ class Controller:
             loop.join()
         except (KeyboardInterrupt, SystemExit):
             logging.info("Got Interrupt signal, bye!")
-            self.exit_loop.set()
+            self.stop()
         except IOError as ioerr:
             logging.error("Got IOError: %s", ioerr)
-            self.exit_loop.set()
+            self.stop()
         except Exception as exp:
             logging.warning("Uncaught Exception: %s", exp)
-            self.exit_loop.set()
+            self.stop()
 
         # Cleanup
+        self.sampler.shutdown()
+        if self.recorder is not None:
+            self.recorder.close()
         if self.monitor:
             logging.info("Monitor mode, not restoring fans to automatic mode")
         else:
             logging.info("Restoring fans to automatic mode")
             self._release_fans()
+        self._close_devices()
+
+
+def controller_from_config(conf: Config, monitor: bool = False) -> Controller:
+    """Generate a Controller with its Fans and Sensors from configuration"""
+    fan_list = []
+    for fan_conf in conf.get_fans_config():
+        fan_list.append(Fan(fan_conf))
+    apply_calibrations(fan_list, conf.get_calibration_file())
+
+    sensor_list = []
+    for sensor_conf in conf.get_sensors_config():
+        sensor_list.append(Sensor(sensor_conf))
+
+    interval = conf.get_interval()
+
+    if conf.get_sampling() == "concurrent":
+        sensor_sampler = ConcurrentSampler(conf.get_sampling_workers())
+    else:
+        sensor_sampler = Sampler()
+
+    adaptive_conf = conf.get_adaptive_config()
+    if adaptive_conf["max_interval"] > interval:
+        adapter = IntervalAdapter(**adaptive_conf)
+    else:
+        adapter = None
+
+    return Controller(fan_list,
+                      sensor_list,
+                      interval,
+                      monitor,
+                      sensor_sampler,
+                      adapter,
+                      conf.get_stats_interval(),
+                      **conf.get_events_config()
+                      )
@@ -0,0 +1,302 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import time
+from hhfc.config import Config
+from hhfc.controller import Controller, RESUME_CHECK_INTERVAL, RESUME_CLOCK_JUMP, _suspended_time
+from hhfc.fan import Fan
+from hhfc.sensor import Sensor
+from hhfc.sampler import _timed_read
+from hhfc.adaptive import IntervalAdapter
+from hhfc.calibrate import apply_calibrations
+
+# Name of the zone made of the top level FANS
+DEFAULT_ZONE = "default"
+
+# A sensor sample younger than this fraction of the sensor interval is shared
+# with every zone asking for it instead of reading the sensor again
+SHARED_SAMPLE_AGE = 0.5
+
+
+class AsyncEngine:
+    """Runs several cooling zones in a single asyncio event loop. Each zone is
+    a Controller with its own interval and fans. Sensors are shared: a sensor
+    used by many zones is read once and the sample is used by all of them.
+    Reads are done in a thread pool so a slow driver does not stall other
+    zones
+    """
+
+    zones: dict[str, Controller]
+    sensors: list[Sensor]
+    monitor: bool
+    workers: int
+    inflight: dict[Sensor, asyncio.Future]
+
+    def __init__(self,
+                 zones: dict[str, Controller],
+                 sensors: list[Sensor],
+                 monitor=False,
+                 workers: int = 4
+                 ):
+        self.zones = zones
+        self.sensors = sensors
+        self.monitor = monitor
+        self.workers = workers
+        self.inflight = {}
+        self._executor = None
+        self._event_loop = None
+        self._stopped = None
+
+    @property
+    def fans(self) -> list[Fan]:
+        """All fans of every zone"""
+        return [fan for zone in self.zones.values() for fan in zone.fans]
+
+    async def sample(self, sensors: list[Sensor]) -> None:
+        """Read `sensors` unless they have a fresh enough sample. A read
+        already in flight for another zone is waited for instead of issuing a
+        new one. Sensors not answering before their timeout keep their last
+        good value and are updated whenever the read finishes
+        """
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        waiting = []
+        for sensor in sensors:
+            future = self.inflight.get(sensor)
+            if future is None:
+                if (sensor.timestamp is not None
+                        and now - sensor.timestamp < sensor.interval * SHARED_SAMPLE_AGE):
+                    continue
+                future = loop.run_in_executor(self._executor, _timed_read, sensor)
+                future.add_done_callback(functools.partial(self._collect, sensor))
+                self.inflight[sensor] = future
+            waiting.append(future)
+        if not waiting:
+            return
+
+        _, pending = await asyncio.wait(waiting, timeout=max(sensor.timeout for sensor in sensors))
+        for sensor in sensors:
+            future = self.inflight.get(sensor)
+            if future in pending:
+                if sensor.value is None:
+                    logging.warning("Sensor '%s' is late and has no value yet", sensor.name)
+                else:
+                    logging.warning("Sensor '%s' is late, using value from %.2fs ago",
+                                    sensor.name,
+                                    sensor.get_age()
+                                    )
+        for future in waiting:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def _collect(self, sensor: Sensor, future: asyncio.Future) -> None:
+        """Update the sensor with a finished read"""
+        del self.inflight[sensor]
+        if not future.cancelled() and future.exception() is None:
+            sensor.update(*future.result())
+
+    async def _run_zone(self, name: str, zone: Controller) -> None:
+        """Control loop of a zone. Same as Controller._loop with the sensor
+        reads awaited
+        """
+        logging.debug("Starting zone %s, interval %.2fs", name, zone.loop_interval)
+        next_report = time.monotonic() + zone.stats_interval
+        suspended = _suspended_time()
+        while True:
+            last_suspended, suspended = suspended, _suspended_time()
+            if suspended - last_suspended > RESUME_CLOCK_JUMP:
+                logging.info("Zone %s resumed after %.0fs suspended",
+                             name,
+                             suspended - last_suspended
+                             )
+                zone.resume_pending = True
+            if zone.resume_pending:
+                zone._resume()
+            start = time.monotonic()
+            zone._start_iter(start)
+            if zone._due_sensors:
+                await self.sample(zone._due_sensors)
+            next_due = zone._finish_iter(start)
+            end = time.monotonic()
+            zone.stats.tick.add(end - start)
+
+            if zone.stats_interval and end >= next_report:
+                logging.info("Zone %s statistics:", name)
+                zone._log_stats()
+                next_report = end + zone.stats_interval
+
+            await self._sleep(max(next_due - end, 0))
+
+    async def _sleep(self, timeout: float) -> None:
+        """Sleep for `timeout` seconds or until the system resumes from
+        suspend, as Controller._wait
+        """
+        deadline = time.monotonic() + timeout
+        suspended = _suspended_time()
+        while True:
+            await asyncio.sleep(min(max(deadline - time.monotonic(), 0), RESUME_CHECK_INTERVAL))
+            if time.monotonic() >= deadline:
+                break
+            if _suspended_time() - suspended > RESUME_CLOCK_JUMP:
+                break
+
+    async def _main(self) -> None:
+        """Run every zone until stopped or one of them fails"""
+        self._event_loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        tasks = [
+            asyncio.create_task(self._run_zone(name, zone), name=f"hhfc-zone-{name}")
+            for name, zone in self.zones.items()
+        ]
+        stopper = asyncio.create_task(self._stopped.wait())
+        done, _ = await asyncio.wait(tasks + [stopper], return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks + [stopper]:
+            task.cancel()
+        await asyncio.gather(*tasks, stopper, return_exceptions=True)
+        for task in done:
+            if task is not stopper and task.exception() is not None:
+                raise task.exception()
+
+    def stop(self) -> None:
+        """Ask the event loop to exit. Safe to call from signal handlers and
+        other threads
+        """
+        if self._event_loop is not None:
+            self._event_loop.call_soon_threadsafe(self._stopped.set)
+
+    def reload(self, conf: Config) -> bool:
+        """Reloading is not supported by this engine"""
+        logging.warning("The asyncio engine can't reload its configuration, "
+                        "restart hhfc to apply it")
+        return False
+
+    def request_rpm(self, duration: float) -> None:
+        """Ask every zone to read fan speeds during the next `duration`
+        seconds
+        """
+        for zone in self.zones.values():
+            zone.request_rpm(duration)
+
+    def get_state(self) -> dict:
+        """Returns a snapshot of every zone, merged as a single controller
+        state with the loop statistics of each zone under `zones`
+        """
+        state = {"sensors": {}, "fans": {}, "zones": {}}
+        for name, zone in self.zones.items():
+            zone_state = zone.get_state()
+            state["sensors"].update(zone_state["sensors"])
+            state["fans"].update(zone_state["fans"])
+            state["zones"][name] = zone_state["loop"]
+        loops = state["zones"].values()
+        state["loop"] = {
+            "effective_interval": min(loop["effective_interval"] for loop in loops),
+            "tick_p50": max(loop["tick_p50"] for loop in loops),
+            "tick_p99": max(loop["tick_p99"] for loop in loops),
+            "tick_max": max(loop["tick_max"] for loop in loops),
+            "missed_deadlines": sum(loop["missed_deadlines"] for loop in loops),
+            "alarms": sum(loop["alarms"] for loop in loops),
+        }
+        return state
+
+    def run(self):
+        """Runs every zone. This does not exit until interrupted"""
+
+        # Set up
+        zones = self.zones.values()
+        if self.monitor:
+            logging.info("Monitor mode, not taking over fans")
+        else:
+            logging.info("Taking over fans")
+            for zone in zones:
+                zone._take_over_fans()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="hhfc-sampler"
+        )
+
+        logging.debug("Starting event loop with %i zones", len(self.zones))
+        try:
+            asyncio.run(self._main())
+        except (KeyboardInterrupt, SystemExit):
+            logging.info("Got Interrupt signal, bye!")
+        except IOError as ioerr:
+            logging.error("Got IOError: %s", ioerr)
+        except Exception as exp:
+            logging.warning("Uncaught Exception: %s", exp)
+
+        # Cleanup
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._event_loop = None
+        if self.monitor:
+            logging.info("Monitor mode, not restoring fans to automatic mode")
+        else:
+            logging.info("Restoring fans to automatic mode")
+            for zone in zones:
+                zone._release_fans()
+        for zone in zones:
+            zone._close_devices()
+
+
+def engine_from_config(conf: Config, monitor: bool = False) -> AsyncEngine:
+    """Generate an AsyncEngine with a zone for each entry of ZONES, and one
+    named `default` for the top level FANS if any
+    """
+    sensors = [Sensor(sensor_conf) for sensor_conf in conf.get_sensors_config()]
+
+    zones_conf = list(conf.get_zones_config())
+    if conf.get_fans_config():
+        zones_conf.insert(0, {
+            "name": DEFAULT_ZONE,
+            "interval": conf.get_interval(),
+            "fans": conf.get_fans_config(),
+        })
+    if not zones_conf:
+        raise ValueError("No fans defined in FANS or ZONES")
+
+    adaptive_conf = conf.get_adaptive_config()
+    zones = {}
+    fan_names = set()
+    for zone_conf in zones_conf:
+        name = zone_conf["name"]
+        if name in zones:
+            raise ValueError(f"Repeated zone name: {name}")
+        fans = [Fan(fan_conf) for fan_conf in zone_conf["fans"]]
+        apply_calibrations(fans, conf.get_calibration_file())
+        for fan in fans:
+            if fan.name in fan_names:
+                raise ValueError(f"Fan name used in more than one zone: {fan.name}")
+            fan_names.add(fan.name)
+        used = {sensor_conf["name"] for fan in fans for sensor_conf in fan.sensors}
+        interval = zone_conf["interval"]
+        if adaptive_conf["max_interval"] > interval:
+            adapter = IntervalAdapter(**adaptive_conf)
+        else:
+            adapter = None
+        zones[name] = Controller(fans,
+                                 [sensor for sensor in sensors if sensor.name in used],
+                                 interval,
+                                 monitor,
+                                 adapter=adapter,
+                                 stats_interval=conf.get_stats_interval()
+                                 )
+
+    return AsyncEngine(zones, sensors, monitor, conf.get_sampling_workers())
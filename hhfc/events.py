@@ -0,0 +1,136 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import logging
+import os
+import select
+from .hwmon import Attribute
+from .sensor import Sensor
+
+# Events to wait for on alarm attributes. sysfs notifies changes with
+# POLLPRI | POLLERR, regular readiness is always reported and must be ignored
+ALARM_EVENTS = select.POLLPRI | select.POLLERR
+
+# Alarm attributes a driver may expose for a tempN sensor
+ALARM_SUFFIXES = ("_max_alarm", "_min_alarm", "_alarm")
+
+
+class SensorAlarm:
+    """Limit and alarm attributes of a hwmon temperature sensor. The limits
+    are programmed around the current reading so the driver raises an alarm,
+    that can be waited for with poll(), when the reading leaves that window.
+    The `tempN_crit` limits are left alone, they may be used by the hardware
+    to protect itself
+    """
+
+    sensor: Sensor
+    breakpoints: list[float]
+    band: float
+    max_limit: Attribute
+    min_limit: Attribute
+    alarms: list[Attribute]
+    lower: float
+    upper: float
+
+    def __init__(self, sensor: Sensor, breakpoints: list[float], band: float):
+        self.sensor = sensor
+        self.breakpoints = sorted(set(breakpoints))
+        self.band = band
+        prefix = sensor.sensor_input.name.removesuffix("_input")
+        device = sensor.device
+        self.max_limit = device.attribute(prefix + "_max", writable=True)
+        self.min_limit = device.attribute(prefix + "_min", writable=True)
+        self.alarms = [
+            device.attribute(prefix + suffix) for suffix in ALARM_SUFFIXES
+            if os.path.exists(device.path + prefix + suffix)
+        ]
+        self._saved = {}
+        self.lower = None
+        self.upper = None
+
+    def probe(self) -> bool:
+        """Check that the driver exposes an alarm and lets us write the upper
+        limit. The lower limit is optional, without it cooling down is only
+        seen by timed polling. Returns False if events can't be used
+        """
+        if not self.alarms:
+            return False
+        for limit in (self.max_limit, self.min_limit):
+            try:
+                value = limit.read_int()
+                limit.write(value)
+                self._saved[limit] = value
+            except (OSError, ValueError):
+                limit.close()
+        if self.max_limit not in self._saved:
+            return False
+        self.arm()
+        return True
+
+    def fds(self) -> list[int]:
+        """Returns the file descriptors of the alarm attributes to poll"""
+        return [alarm.fd for alarm in self.alarms]
+
+    def arm(self) -> None:
+        """Read the alarm attributes. sysfs only notifies again once the
+        attribute has been read after the last notification
+        """
+        for alarm in self.alarms:
+            alarm.read()
+
+    def program(self, value: float) -> bool:
+        """Move the limits around `value` if it left the current window. The
+        window spans `band` degrees each side, narrowed to the curve segment
+        `value` is in so a change of slope is never missed. Returns True if
+        the limits were written
+        """
+        if self.lower is not None and self.lower < value < self.upper:
+            return False
+        breakpoints = self.breakpoints
+        upper = value + self.band
+        idx = bisect.bisect_right(breakpoints, value)
+        if idx < len(breakpoints):
+            upper = min(upper, breakpoints[idx])
+        lower = value - self.band
+        idx = bisect.bisect_left(breakpoints, value) - 1
+        if idx >= 0:
+            lower = max(lower, breakpoints[idx])
+        self.max_limit.write(self._to_raw(upper))
+        if self.min_limit in self._saved:
+            self.min_limit.write(self._to_raw(lower))
+        self.lower = lower
+        self.upper = upper
+        logging.debug("Sensor %s: alarm window %.1f-%.1f", self.sensor.name, lower, upper)
+        return True
+
+    def _to_raw(self, value: float) -> int:
+        """Convert a temperature to the units of the sensor attributes"""
+        return round((value - self.sensor.offset) * self.sensor.divisor)
+
+    def restore(self) -> None:
+        """Write back the limits found when probing and close the attributes"""
+        for limit, value in self._saved.items():
+            try:
+                limit.write(value)
+            except OSError as exp:
+                logging.warning("Could not restore %s: %s", limit, exp)
+            limit.close()
+        self._saved = {}
+        for alarm in self.alarms:
+            alarm.close()
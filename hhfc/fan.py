@@ -16,22 +16,86 @@ A PARTICULAR PURPOSE. See the GNU General Public License for more details.
 with hhfc. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import bisect
 import logging
-from . import util
+import time
+import weakref
+from .hwmon import Attribute, Device
+from .pid import PidController
 
 class Interpolator:
-    """Interpolator of a curve between given points at initialization"""
+    """Piecewise linear interpolator of a curve between given points at
+    initialization. The segments slopes are precomputed and looked up by
+    bisection. Optionally a dense table with `resolution` spacing is built so
+    evaluation is a single index operation.
+    """
 
-    x_vals: list[int]
-    y_vals: list[int]
+    __slots__ = ("x_vals", "y_vals", "slopes", "resolution", "table", "__weakref__")
 
-    def __init__(self, x_vals: list[int], y_vals: list[int]):
+    x_vals: list[float]
+    y_vals: list[float]
+    slopes: list[float]
+    resolution: float
+    table: list[float]
+
+    def __init__(self, x_vals: list[int], y_vals: list[int], resolution: float = 0):
         if not len(x_vals) == len(y_vals):
             raise ValueError("x_vals and y_vals need to be the same lenght")
-        self.x_vals = x_vals
-        self.y_vals = y_vals
+        if len(x_vals) < 1:
+            raise ValueError("At least one point is needed for the curve")
+        points = sorted(zip(x_vals, y_vals))
+        self.x_vals = [point[0] for point in points]
+        self.y_vals = [point[1] for point in points]
+        for idx in range(1, len(self.x_vals)):
+            if self.x_vals[idx] == self.x_vals[idx - 1]:
+                raise ValueError(f"Repeated point in curve: {self.x_vals[idx]}")
+        self.slopes = [
+            (self.y_vals[idx + 1] - self.y_vals[idx]) / (self.x_vals[idx + 1] - self.x_vals[idx])
+            for idx in range(len(self.x_vals) - 1)
+        ]
+        self.resolution = resolution
+        self.table = None
+        if resolution:
+            self._build_table()
+
+    def _build_table(self) -> None:
+        """Precompute the curve values every `resolution` degrees"""
+        if self.resolution < 0:
+            raise ValueError("Curve resolution must be a positive number")
+        steps = int((self.x_vals[-1] - self.x_vals[0]) / self.resolution) + 1
+        self.table = [
+            self._evaluate(self.x_vals[0] + step * self.resolution) for step in range(steps)
+        ]
+        self.table.append(self.y_vals[-1])
+
+    def _evaluate(self, x: float) -> float:
+        """Evaluate the curve at x, x must be inside the curve limits"""
+        idx = bisect.bisect_right(self.x_vals, x) - 1
+        if idx >= len(self.slopes):
+            return self.y_vals[-1]
+        return self.y_vals[idx] + self.slopes[idx] * (x - self.x_vals[idx])
+
+    def get_value(self, x: float) -> float:
+        """Evaluate at x, if x is lower than the lowest x, return the lowest
+        value
+        """
+        if x <= self.x_vals[0]:
+            return self.y_vals[0]
+        if x >= self.x_vals[-1]:
+            return self.y_vals[-1]
+        if self.table is not None:
+            return self.table[int((x - self.x_vals[0]) / self.resolution + 0.5)]
+        return self._evaluate(x)
+
 
-    def _compute_l_poly_value(self, j: int, x: int) -> int:
+class LagrangeInterpolator(Interpolator):
+    """Interpolator of a curve with a single lagrange polynomial through all
+    the given points
+    """
+
+    __slots__ = ()
+
+    def _compute_l_poly_value(self, j: int, x: float) -> float:
         """Compute the j-th lagrange polynomial at point x"""
         k = len(self.x_vals)
         result = 1
@@ -41,15 +105,7 @@ class Interpolator:
             result *= (x - self.x_vals[m]) / (self.x_vals[j] - self.x_vals[m])
         return result
 
-    def get_value(self, x: int) -> int:
-        """Evaluate at x, if x is lower than the lowest x, return the lowest
-        value
-        """
-        if x < self.x_vals[0]:
-            return self.y_vals[0]
-        if x > self.x_vals[-1]:
-            return self.y_vals[-1]
-
+    def _evaluate(self, x: float) -> float:
         k = len(self.x_vals)
         result = 0
         for j in range(k):
@@ -58,55 +114,293 @@ class Interpolator:
         return result
 
 
+INTERPOLATORS = {
+    "linear": Interpolator,
+    "lagrange": LagrangeInterpolator,
+}
+
+# Interpolators in use, by interpolation, points and resolution. Fans with the
+# same curve share a single object
+_interned_curves = weakref.WeakValueDictionary()
+
+
+def intern_curve(interpolation: str, points: list, resolution: float = 0) -> Interpolator:
+    """Returns an Interpolator for `points`. Identical curves return the same
+    object, so callers can cache results by curve
+    """
+    key = (interpolation, tuple(sorted((point[0], point[1]) for point in points)), resolution)
+    curve = _interned_curves.get(key)
+    if curve is None:
+        curve = INTERPOLATORS[interpolation](
+            [point[0] for point in points],
+            [point[1] for point in points],
+            resolution
+        )
+        _interned_curves[key] = curve
+    return curve
+
+
+def dump_curves(curves: list[Interpolator]) -> list[tuple]:
+    """Returns interned `curves`, with their precomputed slopes and tables,
+    as plain data that can be stored and loaded back with `load_curves`
+    """
+    return [(key, curve.slopes, curve.table) for key, curve in _interned_curves.items()
+            if any(curve is wanted for wanted in curves)]
+
+
+def load_curves(dumped: list[tuple]) -> list[Interpolator]:
+    """Intern curves saved with `dump_curves` without computing them again.
+    Curves are only kept while referenced, so callers have to hold the
+    returned list until fans using them are created
+    """
+    curves = []
+    for key, slopes, table in dumped:
+        interpolation, points, resolution = key
+        curve = _interned_curves.get(key)
+        if curve is None:
+            curve = INTERPOLATORS[interpolation].__new__(INTERPOLATORS[interpolation])
+            curve.x_vals = [point[0] for point in points]
+            curve.y_vals = [point[1] for point in points]
+            curve.slopes = list(slopes)
+            curve.resolution = resolution
+            curve.table = None if table is None else list(table)
+            _interned_curves[key] = curve
+        curves.append(curve)
+    return curves
+
+
+class FanCalibration:
+    """Measured PWM to RPM response of a fan, used to map duty cycles to PWM
+    values linearly in speed: a duty cycle is a percentage of the maximum
+    speed. `stall_pwm` is the lowest PWM value that keeps the fan spinning
+    and `start_pwm` the lowest that starts it when stopped
+    """
+
+    __slots__ = ("pwm_path", "points", "stall_pwm", "start_pwm", "max_rpm", "_pwms", "_rpms")
+
+    pwm_path: str
+    points: list[tuple[int, int]]
+    stall_pwm: int
+    start_pwm: int
+    max_rpm: int
+
+    def __init__(self,
+                 pwm_path: str,
+                 points: list[tuple[int, int]],
+                 stall_pwm: int,
+                 start_pwm: int
+                 ):
+        if not points:
+            raise ValueError("At least one calibration point is needed")
+        self.pwm_path = pwm_path
+        self.points = sorted((int(pwm), int(rpm)) for pwm, rpm in points)
+        self.stall_pwm = stall_pwm
+        self.start_pwm = start_pwm
+        # Speed has to grow with PWM to be inverted, measuring noise is
+        # flattened out
+        self._pwms = []
+        self._rpms = []
+        top = -1
+        for pwm, rpm in self.points:
+            if rpm > top:
+                self._pwms.append(pwm)
+                self._rpms.append(rpm)
+                top = rpm
+        self.max_rpm = top
+
+    def get_pwm(self, duty_cycle: float, last_pwm: int = None) -> int:
+        """Returns the PWM value for a duty cycle. A fan stopped or in an
+        unknown state gets at least `start_pwm`
+        """
+        if duty_cycle <= 0 or self.max_rpm <= 0:
+            return self.points[0][0]
+        target = duty_cycle * self.max_rpm / 100.0
+        pwms = self._pwms
+        rpms = self._rpms
+        idx = bisect.bisect_left(rpms, target)
+        if idx >= len(rpms):
+            pwm = pwms[-1]
+        elif idx == 0:
+            pwm = pwms[0]
+        else:
+            slope = (pwms[idx] - pwms[idx - 1]) / (rpms[idx] - rpms[idx - 1])
+            pwm = pwms[idx - 1] + slope * (target - rpms[idx - 1])
+        pwm = max(round(pwm), self.stall_pwm)
+        if (last_pwm is None or last_pwm < self.stall_pwm) and pwm < self.start_pwm:
+            pwm = self.start_pwm
+        return pwm
+
+    def to_dict(self) -> dict:
+        """Returns the calibration as plain data to store"""
+        return {
+            "pwm_path": self.pwm_path,
+            "points": [list(point) for point in self.points],
+            "stall_pwm": self.stall_pwm,
+            "start_pwm": self.start_pwm,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FanCalibration":
+        """Create a calibration from data returned by `to_dict`"""
+        return cls(data["pwm_path"], data["points"], data["stall_pwm"], data["start_pwm"])
+
+
 class Fan:
     """Class to represent and control a fan"""
 
+    __slots__ = (
+        "name", "driver_name", "device", "pwm_input", "pwm_enable", "fan_input",
+        "min_val", "max_val", "allow_shutoff", "min_allowed", "sensors",
+        "interpolation", "curve_resolution", "interpolator", "interval",
+        "hysteresis", "max_step_per_second", "control_check_interval",
+        "in_control", "last_control_check", "last_pwm", "writes_issued",
+        "writes_skipped", "rpm", "calibration", "stall_check_interval",
+        "last_stall_check", "stall_suspect", "stalled", "mode", "pids",
+    )
+
     name: str
     driver_name: str
-    pwm_input: str
-    pwm_enable: str
-    fan_input: str
+    device: Device
+    pwm_input: Attribute
+    pwm_enable: Attribute
+    fan_input: Attribute
     min_val: int
     max_val: int
     allow_shutoff: bool
     min_allowed: int
     sensors: list[dict]
+    interpolation: str
+    curve_resolution: float
     interpolator: dict
+    interval: float
+    hysteresis: float
+    max_step_per_second: float
+    control_check_interval: float
+    in_control: bool
+    last_control_check: float
+    last_pwm: int
+    writes_issued: int
+    writes_skipped: int
+    rpm: int
+    calibration: FanCalibration
+    stall_check_interval: float
+    last_stall_check: float
+    stall_suspect: bool
+    stalled: bool
+    mode: str
+    pids: dict[str, PidController]
 
     def __init__(self, fan_config: dict):
-        full_path = util.find_driver_path(fan_config["driver_name"])
-
         self.name = fan_config["name"]
         self.driver_name = fan_config["driver_name"]
-        self.fan_input = full_path + fan_config["fan_input"]
-        self.pwm_enable = full_path + fan_config["handle"] + "_enable"
-        self.pwm_input = full_path + fan_config["handle"]
+        self.device = Device(fan_config["driver_name"], fan_config["device"])
+        self.fan_input = self.device.attribute(fan_config["fan_input"])
+        self.pwm_enable = self.device.attribute(fan_config["handle"] + "_enable", writable=True)
+        self.pwm_input = self.device.attribute(fan_config["handle"], writable=True)
         self.min_val = fan_config["min_control_value"]
         self.max_val = fan_config["max_control_value"]
         self.allow_shutoff = (fan_config["allow_shutoff"] == "yes")
         self.min_allowed = fan_config["minimum_duty_cycle"]
         self.sensors = fan_config["sensors"]
-        self.interpolator = {
-            sens["name"]:self._generate_interpolator(sens["name"]) for sens in self.sensors
-        }
+        self.interpolation = fan_config["interpolation"]
+        if self.interpolation not in INTERPOLATORS:
+            raise ValueError(f"Unknown interpolation for fan {self.name}: {self.interpolation}")
+        self.curve_resolution = fan_config["curve_resolution"]
+        self.mode = fan_config["mode"]
+        if self.mode == "curve":
+            self.interpolator = {
+                sens["name"]:self._generate_interpolator(sens["name"]) for sens in self.sensors
+            }
+            self.pids = {}
+        elif self.mode == "pid":
+            self.interpolator = {}
+            self.pids = {
+                sens["name"]:self._generate_pid(sens, fan_config) for sens in self.sensors
+            }
+        else:
+            raise ValueError(f"Unknown mode for fan {self.name}: {self.mode}")
+        self.interval = fan_config["interval"]
+        self.hysteresis = fan_config["hysteresis"]
+        self.max_step_per_second = fan_config["max_step_per_second"]
+        if self.hysteresis < 0 or self.max_step_per_second < 0:
+            raise ValueError("hysteresis and max_step_per_second can't be negative "
+                             f"for fan {self.name}")
+        self.control_check_interval = fan_config["control_check_interval"]
+        self.in_control = False
+        self.last_control_check = None
+        self.last_pwm = None
+        self.writes_issued = 0
+        self.writes_skipped = 0
+        self.rpm = None
+        self.calibration = None
+        self.stall_check_interval = fan_config["stall_check_interval"]
+        self.last_stall_check = None
+        self.stall_suspect = False
+        self.stalled = False
 
     def take_control(self) -> bool:
         """Atempt to take control of the fan from automatic control"""
-        with open(self.pwm_enable, "r+", encoding="utf-8") as enable:
-            enable.write("1")
+        self.last_pwm = None
+        self.pwm_enable.write(1)
         return self.check_control()
 
     def release_control(self) -> bool:
         """Atempt to take control of the fan from automatic control"""
-        with open(self.pwm_enable, "r+", encoding="utf-8") as enable:
-            enable.write("0")
+        self.last_pwm = None
+        self.pwm_enable.write(0)
         return not self.check_control()
 
     def check_control(self) -> bool:
         """Check if we are controlling this fan"""
-        with open(self.pwm_enable, "r", encoding="utf-8") as enable:
-            string = enable.read()
-            return int(string) == 1
+        self.in_control = self.pwm_enable.read_int() == 1
+        self.last_control_check = time.monotonic()
+        return self.in_control
+
+    def invalidate_control(self) -> None:
+        """Forget the cached control state and last written value. The next
+        call to `set_duty_cycle` will verify control and write unconditionally
+        """
+        self.last_control_check = None
+        self.last_pwm = None
+
+    def _control_check_due(self) -> bool:
+        """Whether the cached control state needs to be verified again"""
+        return (self.last_control_check is None
+                or time.monotonic() - self.last_control_check >= self.control_check_interval)
+
+    def close(self) -> None:
+        """Close the hwmon attributes of this fan, they are opened again when
+        next used
+        """
+        self.pwm_input.close()
+        self.pwm_enable.close()
+        self.fan_input.close()
+
+    def same_hardware(self, other: "Fan") -> bool:
+        """Whether `other` drives the same hwmon attributes as this fan"""
+        return (self.pwm_input.path == other.pwm_input.path
+                and self.fan_input.path == other.fan_input.path)
+
+    def adopt(self, other: "Fan") -> None:
+        """Take over the open attributes and control state of `other`, a fan
+        driving the same hardware, so it keeps control without rewriting
+        """
+        self.device = other.device
+        self.pwm_input = other.pwm_input
+        self.pwm_enable = other.pwm_enable
+        self.fan_input = other.fan_input
+        self.in_control = other.in_control
+        self.last_control_check = other.last_control_check
+        self.last_pwm = other.last_pwm
+        self.writes_issued = other.writes_issued
+        self.writes_skipped = other.writes_skipped
+        self.rpm = other.rpm
+        self.last_stall_check = other.last_stall_check
+        self.stall_suspect = other.stall_suspect
+        self.stalled = other.stalled
+        for sensor, pid in self.pids.items():
+            if sensor in other.pids:
+                pid.adopt(other.pids[sensor])
 
     def get_sensor_curve(self, sensor: str) -> dict:
         """Returns the curve for sensor."""
@@ -118,22 +412,43 @@ class Fan:
     def _generate_interpolator(self, sensor: str) -> Interpolator:
         """Returns a Interpolator object for given sensor name"""
         curve = self.get_sensor_curve(sensor)
-        temps = [ column[0] for column in curve ]
-        dutys = [ column[1] for column in curve ]
-        return Interpolator(temps, dutys)
+        return intern_curve(self.interpolation, curve, self.curve_resolution)
+
+    def _generate_pid(self, sensor_config: dict, fan_config: dict) -> PidController:
+        """Returns a PidController holding a sensor at its target temperature,
+        with output limited to the duty cycles this fan allows
+        """
+        if "target_temperature" not in sensor_config:
+            raise ValueError(f"Sensor {sensor_config['name']} of fan {self.name} "
+                             "needs a target_temperature")
+        return PidController(sensor_config["target_temperature"],
+                             fan_config["pid_kp"],
+                             fan_config["pid_ki"],
+                             fan_config["pid_kd"],
+                             0 if self.allow_shutoff else self.min_allowed,
+                             100,
+                             fan_config["pid_deadband"]
+                             )
 
     def get_desired_duty_cycle(self, sensor: str, value: int) -> int:
         """Returns duty cycle for the current sensor state according to the
         specified curve
         """
-        interp = self.interpolator[sensor].get_value(value)
-        # Modify value with shutoff and min_value policy
-        if interp <= self.min_allowed:
+        return self.get_curve_duty_cycle(self.interpolator[sensor], value)
+
+    def get_curve_duty_cycle(self, curve: Interpolator, value: float) -> float:
+        """Returns duty cycle for `value` according to an already looked up
+        curve of this fan
+        """
+        return self.limit_duty_cycle(curve.get_value(value))
+
+    def limit_duty_cycle(self, duty_cycle: float) -> float:
+        """Apply the shutoff and min_value policy to a duty cycle"""
+        if duty_cycle <= self.min_allowed:
             if not self.allow_shutoff:
-                interp = self.min_allowed
-            else:
-                interp = 0
-        return interp
+                return self.min_allowed
+            return 0
+        return duty_cycle
 
     def set_duty_cycle(self, duty_cycle: int) -> None:
         """Sets duty cycle for this fan in the range [min_value-max_value]
@@ -143,30 +458,88 @@ class Fan:
         value than "minimum_duty_cycle".
         If the fan has shut-off policy set to "yes" then any value below
         "minimum_duty_cycle" will make the fan to turn off completely.
+        If the fan is calibrated the duty cycle is a percentage of its maximum
+        speed instead.
+        The hwmon attribute is only written when the value changes and the
+        control state is verified every "control_check_interval" seconds.
         """
         if duty_cycle < 0 or duty_cycle > 100:
             raise ValueError("Duty cycle has to be in the range [0-100]")
 
         # Enforce shutoff and min_value policy
-        if duty_cycle <= self.min_allowed:
-            if not self.allow_shutoff:
-                duty_cycle = self.min_allowed
-            else:
-                duty_cycle = 0
+        duty_cycle = self.limit_duty_cycle(duty_cycle)
 
         # Scale value
-        duty = duty_cycle * (self.max_val - self.min_val) / 100.0
-
-        if not self.check_control():
-            logging.warning("Cant write to the fan control file. Duty cycle setting may fail")
-
-        with open(self.pwm_input, "w", encoding="utf-8") as pwm:
-            pwm.write(str(int(duty)))
+        if self.calibration is not None:
+            self.set_pwm(self.calibration.get_pwm(duty_cycle, self.last_pwm))
+        else:
+            self.set_pwm(int(duty_cycle * (self.max_val - self.min_val) / 100.0))
+
+    def set_pwm(self, pwm_value: int) -> None:
+        """Write a raw PWM value to the fan, unless it was the last one
+        written
+        """
+        if self._control_check_due():
+            if not self.check_control():
+                logging.warning("Cant write to the fan control file. Duty cycle setting may fail")
+                self.last_pwm = None
+
+        if pwm_value == self.last_pwm:
+            self.writes_skipped += 1
+            return
+
+        try:
+            self.pwm_input.write(pwm_value)
+        except OSError as err:
+            logging.error("fan %s: could not write duty cycle: %s", self.name, err)
+            self.invalidate_control()
+            return
+        self.last_pwm = pwm_value
+        self.writes_issued += 1
 
     def read_input(self) -> int:
         """Read input for this fan. The value units are not converted"""
-        with open(self.fan_input, "r", encoding="utf-8") as inp:
-            return int(inp.read())
+        self.rpm = self.fan_input.read_int()
+        return self.rpm
+
+    def should_spin(self) -> bool:
+        """Whether the last value written is enough to start the fan: its
+        calibrated start PWM, or above the PWM of "minimum_duty_cycle" if not
+        calibrated
+        """
+        if not self.in_control or self.last_pwm is None:
+            return False
+        if self.calibration is not None:
+            return self.last_pwm >= self.calibration.start_pwm
+        return self.last_pwm > int(self.min_allowed * (self.max_val - self.min_val) / 100.0)
+
+    def stall_check_due(self, now: float) -> bool:
+        """Whether the fan speed has to be checked for a stall at `now`"""
+        return (self.stall_check_interval > 0
+                and (self.last_stall_check is None
+                     or now - self.last_stall_check >= self.stall_check_interval))
+
+    def check_stall(self, now: float) -> bool:
+        """Flag the fan as stalled if it reports 0 RPM on two checks in a row
+        while driven to spin, a single one may be a fan still spinning up.
+        The speed is only read if the fan should spin. Returns True if
+        stalled
+        """
+        self.last_stall_check = now
+        if self.should_spin() and self.read_input() == 0:
+            stalled = self.stall_suspect
+            self.stall_suspect = True
+        else:
+            stalled = self.stall_suspect = False
+        if stalled and not self.stalled:
+            logging.warning("fan %s: 0 RPM at PWM %i, stalled or disconnected?",
+                            self.name,
+                            self.last_pwm
+                            )
+        elif self.stalled and not stalled:
+            logging.info("fan %s: no longer stalled", self.name)
+        self.stalled = stalled
+        return stalled
 
     def __str__(self) -> str:
         return (self.name + ": " + str(self.read_input()))
@@ -0,0 +1,166 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import abc
+import bisect
+
+
+class Filter(abc.ABC):
+    """Streaming filter of sensor readings. Filters keep a fixed amount of
+    state and take constant time per sample
+    """
+
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def update(self, value: float) -> float:
+        """Add a new reading and return the filtered value"""
+
+    @abc.abstractmethod
+    def reset(self) -> None:
+        """Forget all past readings"""
+
+    @abc.abstractmethod
+    def same_settings(self, other: "Filter") -> bool:
+        """Whether `other` filters the same way, so its state can be kept"""
+
+
+class EmaFilter(Filter):
+    """Exponential moving average. `alpha` in (0, 1] is the weight of each new
+    reading, lower values smooth more
+    """
+
+    __slots__ = ("alpha", "value")
+
+    alpha: float
+    value: float
+
+    def __init__(self, alpha: float):
+        if not 0 < alpha <= 1:
+            raise ValueError("EMA filter alpha has to be in the range (0, 1]")
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value: float) -> float:
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+    def reset(self) -> None:
+        self.value = None
+
+    def same_settings(self, other: Filter) -> bool:
+        return isinstance(other, EmaFilter) and other.alpha == self.alpha
+
+
+class MovingAverageFilter(Filter):
+    """Average of the last `window` readings, kept in a ring buffer with a
+    running sum
+    """
+
+    __slots__ = ("window", "ring", "position", "count", "total")
+
+    window: int
+    ring: list[float]
+    position: int
+    count: int
+    total: float
+
+    def __init__(self, window: int):
+        if window < 1:
+            raise ValueError("Filter window has to be at least 1")
+        self.window = window
+        self.ring = [0.0] * window
+        self.reset()
+
+    def update(self, value: float) -> float:
+        self.total += value - self.ring[self.position]
+        self.ring[self.position] = value
+        self.position = (self.position + 1) % self.window
+        if self.count < self.window:
+            self.count += 1
+        return self.total / self.count
+
+    def reset(self) -> None:
+        for idx in range(self.window):
+            self.ring[idx] = 0.0
+        self.position = 0
+        self.count = 0
+        self.total = 0.0
+
+    def same_settings(self, other: Filter) -> bool:
+        return isinstance(other, MovingAverageFilter) and other.window == self.window
+
+
+class MedianFilter(Filter):
+    """Median of the last `window` readings. A single spike is discarded
+    completely as long as it lasts less than half the window. Readings are
+    kept in a ring buffer and a sorted copy, updated in place
+    """
+
+    __slots__ = ("window", "ring", "position", "ordered")
+
+    window: int
+    ring: list[float]
+    position: int
+    ordered: list[float]
+
+    def __init__(self, window: int):
+        if window < 1:
+            raise ValueError("Filter window has to be at least 1")
+        self.window = window
+        self.ring = [None] * window
+        self.reset()
+
+    def update(self, value: float) -> float:
+        oldest = self.ring[self.position]
+        if oldest is not None:
+            del self.ordered[bisect.bisect_left(self.ordered, oldest)]
+        bisect.insort(self.ordered, value)
+        self.ring[self.position] = value
+        self.position = (self.position + 1) % self.window
+        ordered = self.ordered
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2
+
+    def reset(self) -> None:
+        for idx in range(self.window):
+            self.ring[idx] = None
+        self.position = 0
+        self.ordered = []
+
+    def same_settings(self, other: Filter) -> bool:
+        return isinstance(other, MedianFilter) and other.window == self.window
+
+
+def filter_from_config(sensor_config: dict) -> Filter:
+    """Returns the filter configured for a sensor, None if not filtered"""
+    kind = sensor_config["filter"]
+    if kind == "none":
+        return None
+    if kind == "ema":
+        return EmaFilter(sensor_config["filter_alpha"])
+    if kind == "average":
+        return MovingAverageFilter(sensor_config["filter_window"])
+    if kind == "median":
+        return MedianFilter(sensor_config["filter_window"])
+    raise ValueError(f"Unknown filter for sensor {sensor_config['name']}: {kind}")
@@ -0,0 +1,258 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import errno
+import logging
+import os
+import re
+
+# Where hwmon devices are exposed
+HWMON_ROOT = "/sys/class/hwmon/"
+
+# Size of the buffer used to read attributes. hwmon attributes are single
+# integer values, this is way more than needed.
+READ_BUFFER_SIZE = 32
+
+# Errors that mean the attribute file went away under us. The file is reopened
+# after resolving its device again
+REOPEN_ERRNOS = (errno.ENOENT, errno.ENODEV, errno.ESTALE)
+
+
+def _hwmon_sort_key(entry: str) -> tuple:
+    """Sort hwmonN directories by their number"""
+    match = re.fullmatch(r"hwmon(\d+)", entry)
+    return (0, int(match.group(1)), entry) if match else (1, 0, entry)
+
+
+class HwmonIndex:
+    """Index of hwmon devices under `root` by driver name. Each driver name
+    maps to a list of (hwmon directory, device path) pairs. The index is built
+    on first use and rebuilt only when asked to
+    """
+
+    root: str
+    devices: dict[str, list[tuple[str, str]]]
+    generation: int
+
+    def __init__(self, root: str = HWMON_ROOT):
+        self.root = root
+        self.devices = None
+        self.generation = 0
+
+    def rebuild(self) -> None:
+        """Scan the hwmon root directory and build the index again"""
+        devices = {}
+        for entry in sorted(os.listdir(self.root), key=_hwmon_sort_key):
+            full_path = os.path.join(self.root, entry, "")
+            try:
+                with open(full_path + "name", encoding="utf-8") as name_file:
+                    name = name_file.read().strip()
+            except OSError:
+                continue
+            device_path = os.path.realpath(full_path + "device") \
+                if os.path.exists(full_path + "device") else ""
+            devices.setdefault(name, []).append((full_path, device_path))
+        self.devices = devices
+        self.generation += 1
+        logging.debug("hwmon index built: %i drivers found under %s", len(devices), self.root)
+
+    def invalidate(self, generation: int) -> None:
+        """Rebuild the index if it has not been rebuilt since `generation`.
+        This allows every user of a stale path to ask for a rebuild while
+        scanning the directory only once
+        """
+        if self.devices is None or generation == self.generation:
+            self.rebuild()
+
+    def find(self, driver_name: str, device: str = None) -> str:
+        """Return the hwmon directory for driver `driver_name`. If `device` is
+        given the device path (i.e. PCI address) has to match as well
+        """
+        if self.devices is None:
+            self.rebuild()
+
+        for full_path, device_path in self.devices.get(driver_name, []):
+            if device is None or _device_matches(device, device_path):
+                return full_path
+
+        if device is None:
+            raise RuntimeError(f"Driver with name {driver_name} not found.")
+        raise RuntimeError(f"Driver with name {driver_name} and device {device} not found.")
+
+
+def _device_matches(device: str, device_path: str) -> bool:
+    """Match a configured device against a resolved device path. The device
+    can be the full path or any trailing part of it (i.e. "0000:03:00.0")
+    """
+    if not device_path:
+        return False
+    device = device.rstrip("/")
+    return device_path == device or device_path.endswith("/" + device)
+
+
+# Index shared by every device of the process
+index = HwmonIndex()
+
+
+def set_root(root: str) -> None:
+    """Point the shared index to another hwmon root directory, i.e. a
+    simulated hwmon tree
+    """
+    index.root = root
+    index.devices = None
+
+
+class Device:
+    """A hwmon device, looked up by driver name and optional device path. The
+    hwmon directory is resolved again when its attributes go away, i.e. when
+    hwmon devices are renumbered
+    """
+
+    driver_name: str
+    device: str
+    path: str
+    generation: int
+
+    def __init__(self, driver_name: str, device: str = None, hwmon_index: HwmonIndex = None):
+        self.driver_name = driver_name
+        self.device = device
+        self.index = hwmon_index if hwmon_index is not None else index
+        self.path = None
+        self.generation = None
+        self.resolve()
+
+    def resolve(self) -> str:
+        """Look up the hwmon directory of this device in the index"""
+        self.path = self.index.find(self.driver_name, self.device)
+        self.generation = self.index.generation
+        return self.path
+
+    def refresh(self) -> None:
+        """Rebuild the index if needed and resolve the device again"""
+        old_path = self.path
+        self.index.invalidate(self.generation)
+        if self.resolve() != old_path:
+            logging.info("hwmon driver %s moved from %s to %s",
+                         self.driver_name,
+                         old_path,
+                         self.path
+                         )
+
+    def attribute(self, name: str, writable: bool = False) -> "Attribute":
+        """Returns an Attribute of this device"""
+        return Attribute(self, name, writable)
+
+
+class Attribute:
+    """A hwmon sysfs attribute file. The file is opened once and kept open,
+    reads and writes are done with pread/pwrite at offset 0
+    """
+
+    __slots__ = ("device", "name", "writable", "fd", "_buffer", "_views")
+
+    device: Device
+    name: str
+    writable: bool
+    fd: int
+
+    def __init__(self, device: Device, name: str, writable: bool = False):
+        self.device = device
+        self.name = name
+        self.writable = writable
+        self.fd = -1
+        self._buffer = bytearray(READ_BUFFER_SIZE)
+        self._views = [self._buffer]
+
+    @property
+    def path(self) -> str:
+        """Full path to the attribute file"""
+        return self.device.path + self.name
+
+    def open(self) -> None:
+        """Open the attribute file, if already open this does nothing"""
+        if self.fd >= 0:
+            return
+        flags = os.O_RDWR if self.writable else os.O_RDONLY
+        self.fd = os.open(self.path, flags | os.O_CLOEXEC)
+
+    def close(self) -> None:
+        """Close the attribute file"""
+        if self.fd < 0:
+            return
+        try:
+            os.close(self.fd)
+        finally:
+            self.fd = -1
+
+    def reopen(self) -> None:
+        """Close the attribute file, resolve its device again and reopen it"""
+        self.close()
+        self.device.refresh()
+        self.open()
+
+    def read(self) -> bytes:
+        """Read the raw contents of the attribute"""
+        try:
+            return self._read()
+        except OSError as err:
+            if err.errno not in REOPEN_ERRNOS:
+                raise
+        self.reopen()
+        return self._read()
+
+    def _read(self) -> bytes:
+        self.open()
+        length = os.preadv(self.fd, self._views, 0)
+        return self._buffer[:length]
+
+    def read_int(self) -> int:
+        """Read the attribute as an integer"""
+        return int(self.read())
+
+    def read_float(self) -> float:
+        """Read the attribute as a float"""
+        return float(self.read())
+
+    def write(self, value: int) -> None:
+        """Write an integer value to the attribute"""
+        data = b"%d\n" % value
+        try:
+            self._write(data)
+            return
+        except OSError as err:
+            if err.errno not in REOPEN_ERRNOS:
+                raise
+        self.reopen()
+        self._write(data)
+
+    def _write(self, data: bytes) -> None:
+        self.open()
+        os.pwrite(self.fd, data, 0)
+
+    def __del__(self, _close=os.close):
+        # Module globals may be gone already at interpreter shutdown, the
+        # bound default is not
+        if self.fd >= 0:
+            try:
+                _close(self.fd)
+            except OSError:
+                pass
+            self.fd = -1
+
+    def __str__(self) -> str:
+        return self.path
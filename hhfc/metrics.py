@@ -0,0 +1,193 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import logging
+import os
+import select
+import socket
+import stat
+import threading
+import time
+from hhfc.controller import Controller
+
+# Fan speeds are read by the controller for this long after each socket client
+SOCKET_RPM_LEASE = 60.0
+
+
+def _escape_label(value: str) -> str:
+    """Escape a label value for the Prometheus text format"""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_prometheus(state: dict) -> str:
+    """Format a controller state in the Prometheus text exposition format"""
+    lines = []
+
+    def metric(name: str, kind: str, doc: str, samples: list[tuple[str, object]]) -> None:
+        lines.append(f"# HELP {name} {doc}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if value is not None:
+                lines.append(f"{name}{labels} {value}")
+
+    sensors = state["sensors"]
+    fans = state["fans"]
+    sensor_label = {name: f"{{sensor=\"{_escape_label(name)}\"}}" for name in sensors}
+    fan_label = {name: f"{{fan=\"{_escape_label(name)}\"}}" for name in fans}
+
+    metric("hhfc_sensor_temperature_celsius", "gauge", "Last good sensor reading",
+           [(sensor_label[name], sens["value"]) for name, sens in sensors.items()])
+    metric("hhfc_sensor_raw_temperature_celsius", "gauge",
+           "Last good sensor reading before filtering",
+           [(sensor_label[name], sens["raw_value"]) for name, sens in sensors.items()])
+    metric("hhfc_sensor_age_seconds", "gauge", "Age of the last good sensor reading",
+           [(sensor_label[name], sens["age"]) for name, sens in sensors.items()])
+    metric("hhfc_fan_duty_percent", "gauge", "Last computed fan duty cycle",
+           [(fan_label[name], fan["duty"]) for name, fan in fans.items()])
+    metric("hhfc_fan_pwm", "gauge", "Last raw value written to the fan PWM attribute",
+           [(fan_label[name], fan["pwm"]) for name, fan in fans.items()])
+    metric("hhfc_fan_rpm", "gauge", "Last fan speed read",
+           [(fan_label[name], fan["rpm"]) for name, fan in fans.items()])
+    metric("hhfc_fan_stalled", "gauge", "Whether the fan reports no speed while driven to spin",
+           [(fan_label[name], int(fan["stalled"])) for name, fan in fans.items()])
+    metric("hhfc_fan_writes_total", "counter", "PWM writes issued",
+           [(fan_label[name], fan["writes_issued"]) for name, fan in fans.items()])
+    metric("hhfc_fan_writes_skipped_total", "counter", "PWM writes skipped as unchanged",
+           [(fan_label[name], fan["writes_skipped"]) for name, fan in fans.items()])
+
+    loop = state["loop"]
+    metric("hhfc_loop_interval_seconds", "gauge", "Effective control loop interval",
+           [("", loop["effective_interval"])])
+    metric("hhfc_loop_tick_seconds", "summary", "Control loop iteration duration",
+           [("{quantile=\"0.5\"}", loop["tick_p50"]),
+            ("{quantile=\"0.99\"}", loop["tick_p99"]),
+            ("{quantile=\"1\"}", loop["tick_max"])])
+    metric("hhfc_loop_missed_deadlines", "gauge", "Missed deadlines in the statistics window",
+           [("", loop["missed_deadlines"])])
+    metric("hhfc_loop_alarms", "gauge", "Sensor alarm wakeups in the statistics window",
+           [("", loop["alarms"])])
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """Publishes the state of a running controller. Clients connecting to the
+    unix socket at `socket_path` get one line of JSON with the latest state
+    and the connection is closed. If `textfile_path` is set the state is also
+    written every `textfile_interval` seconds as a node_exporter textfile.
+    No hwmon attribute is read, only cached values are published. Fan speeds
+    are only read by the controller while clients keep asking for them, so
+    the first socket client after a while gets the last speeds read
+    """
+
+    controller: Controller
+    socket_path: str
+    textfile_path: str
+    textfile_interval: float
+
+    def __init__(self,
+                 controller: Controller,
+                 socket_path: str = None,
+                 textfile_path: str = None,
+                 textfile_interval: float = 10.0
+                 ):
+        self.controller = controller
+        self.socket_path = socket_path
+        self.textfile_path = textfile_path
+        self.textfile_interval = textfile_interval
+        self._socket = None
+        self._thread = None
+        self._wakeup = None
+
+    def start(self) -> None:
+        """Start publishing metrics in a background thread"""
+        if self.socket_path:
+            # Left by a previous run, anything else is not ours to remove
+            try:
+                if stat.S_ISSOCK(os.lstat(self.socket_path).st_mode):
+                    os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o666)
+            self._socket.listen()
+            logging.info("Publishing metrics on %s", self.socket_path)
+        self._wakeup = os.pipe()
+        self._thread = threading.Thread(target=self._serve, name="hhfc-metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop publishing metrics and remove the socket"""
+        if self._thread is None:
+            return
+        os.write(self._wakeup[1], b"\0")
+        self._thread.join()
+        self._thread = None
+        for fd in self._wakeup:
+            os.close(fd)
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            os.unlink(self.socket_path)
+
+    def _serve(self) -> None:
+        """Serve socket clients and rewrite the textfile until stopped"""
+        watched = [self._wakeup[0]]
+        if self._socket is not None:
+            watched.append(self._socket)
+        next_write = time.monotonic()
+        while True:
+            timeout = None
+            if self.textfile_path:
+                timeout = max(next_write - time.monotonic(), 0)
+            readable, _, _ = select.select(watched, [], [], timeout)
+            if self._wakeup[0] in readable:
+                return
+            if self._socket in readable:
+                self._send_state()
+            if self.textfile_path and time.monotonic() >= next_write:
+                self._write_textfile()
+                next_write = time.monotonic() + self.textfile_interval
+
+    def _send_state(self) -> None:
+        """Send the state as a JSON line to a connecting client"""
+        try:
+            conn, _ = self._socket.accept()
+        except OSError as err:
+            logging.debug("Metrics client went away: %s", err)
+            return
+        with conn:
+            try:
+                conn.settimeout(1.0)
+                self.controller.request_rpm(SOCKET_RPM_LEASE)
+                conn.sendall(json.dumps(self.controller.get_state()).encode() + b"\n")
+            except OSError as err:
+                logging.debug("Metrics client went away: %s", err)
+
+    def _write_textfile(self) -> None:
+        """Atomically rewrite the node_exporter textfile"""
+        tmp_path = self.textfile_path + ".tmp"
+        self.controller.request_rpm(2 * self.textfile_interval)
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as textfile:
+                textfile.write(format_prometheus(self.controller.get_state()))
+            os.replace(tmp_path, self.textfile_path)
+        except OSError as err:
+            logging.warning("Could not write metrics to %s: %s", self.textfile_path, err)
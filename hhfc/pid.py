@@ -0,0 +1,111 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+class PidController:
+    """PID controller of a fan duty cycle holding a sensor at `target`
+    degrees. The error is the reading minus the target, so a hotter sensor
+    asks for more duty cycle. Time between updates is measured, not assumed,
+    so the integral and derivative terms stay right when the interval
+    changes. The derivative is taken on the reading, a new target does not
+    make the output jump. The integral is kept within what brings the output
+    to its limits along with the other terms (anti-windup), so a sustained
+    error reaches them without winding up past. Errors within `deadband` degrees of the target are
+    taken as none, so the output settles instead of chasing noise
+    """
+
+    __slots__ = (
+        "target", "kp", "ki", "kd", "out_min", "out_max", "deadband",
+        "integral", "last_value", "last_time",
+    )
+
+    target: float
+    kp: float
+    ki: float
+    kd: float
+    out_min: float
+    out_max: float
+    deadband: float
+    integral: float
+    last_value: float
+    last_time: float
+
+    def __init__(self,
+                 target: float,
+                 kp: float,
+                 ki: float,
+                 kd: float,
+                 out_min: float,
+                 out_max: float,
+                 deadband: float = 0
+                 ):
+        if kp < 0 or ki < 0 or kd < 0:
+            raise ValueError("PID gains can't be negative")
+        if deadband < 0:
+            raise ValueError("PID deadband can't be negative")
+        if out_min > out_max:
+            raise ValueError("PID output limits are reversed")
+        self.target = target
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.out_min = out_min
+        self.out_max = out_max
+        self.deadband = deadband
+        self.reset()
+
+    def update(self, value: float, now: float) -> float:
+        """Add a reading taken at `now` and return the new output. The first
+        reading after a reset only has the proportional term
+        """
+        error = value - self.target
+        if abs(error) <= self.deadband:
+            error = 0.0
+        elif error > 0:
+            error -= self.deadband
+        else:
+            error += self.deadband
+        proportional = self.kp * error
+        derivative = 0.0
+        integral = self.integral
+        if self.last_time is not None and now > self.last_time:
+            elapsed = now - self.last_time
+            derivative = self.kd * (value - self.last_value) / elapsed
+            integral += self.ki * error * elapsed
+            # Only integrate up to what saturates the output, the rest would
+            # have to unwind before the output moves again
+            others = proportional + derivative
+            integral = min(max(integral, self.out_min - others), self.out_max - others)
+        self.integral = integral
+        self.last_value = value
+        self.last_time = now
+        return min(max(proportional + integral + derivative, self.out_min), self.out_max)
+
+    def reset(self) -> None:
+        """Forget all past readings"""
+        self.integral = self.out_min
+        self.last_value = None
+        self.last_time = None
+
+    def adopt(self, other: "PidController") -> None:
+        """Continue from the state of `other`. The integral is in output
+        units, so it is kept even if gains changed
+        """
+        self.integral = min(max(other.integral, self.out_min), self.out_max)
+        self.last_value = other.last_value
+        self.last_time = other.last_time
@@ -0,0 +1,187 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import logging
+import math
+import os
+import tempfile
+from hhfc import config, controller, hwmon
+from hhfc.trace import TraceReader
+
+
+class MemoryAttribute:
+    """In memory stand in for a hwmon Attribute"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: float = 0):
+        self.value = value
+
+    def read_int(self) -> int:
+        """Read the attribute as an integer"""
+        return int(self.value)
+
+    def read_float(self) -> float:
+        """Read the attribute as a float"""
+        return float(self.value)
+
+    def write(self, value: int) -> None:
+        """Write an integer value to the attribute"""
+        self.value = value
+
+
+def create_tree(root: str, conf: config.Config) -> None:
+    """Create a hwmon tree with the drivers used by a configuration so its
+    sensors and fans can be resolved
+    """
+    drivers = set()
+    for device_conf in conf.get_sensors_config() + conf.get_fans_config():
+        key = (device_conf["driver_name"], device_conf["device"])
+        if key in drivers:
+            continue
+        path = os.path.join(root, f"hwmon{len(drivers)}")
+        os.makedirs(path)
+        with open(os.path.join(path, "name"), "w", encoding="utf-8") as name:
+            name.write(device_conf["driver_name"] + "\n")
+        if device_conf["device"]:
+            target = os.path.join(root, "devices", device_conf["device"])
+            os.makedirs(target)
+            os.symlink(target, os.path.join(path, "device"))
+        drivers.add(key)
+
+
+def attach_memory_attributes(control: controller.Controller) -> dict[str, MemoryAttribute]:
+    """Replace every hwmon attribute of the controller sensors and fans with
+    in memory ones. Returns the sensor inputs by sensor name
+    """
+    for fan in control.fans:
+        fan.pwm_input = MemoryAttribute()
+        fan.pwm_enable = MemoryAttribute(1)
+        fan.fan_input = MemoryAttribute()
+        # No speed is recorded to check
+        fan.stall_check_interval = 0
+    inputs = {}
+    for sensor in control.sensors:
+        sensor.sensor_input = inputs[sensor.name] = MemoryAttribute()
+    return inputs
+
+
+def replay(reader: TraceReader, config_path: str) -> dict:
+    """Run the controller with the configuration at `config_path` against the
+    recorded sensor values, as fast as possible. Returns a summary of the run
+    """
+    conf = config.Config(config_path)
+    missing = [sensor["name"] for sensor in conf.get_sensors_config()
+               if sensor["name"] not in reader.sensor_names]
+    if missing:
+        raise ValueError(f"Sensors not in trace: {', '.join(missing)}")
+
+    with tempfile.TemporaryDirectory(prefix="hhfc-replay-") as tmp:
+        create_tree(tmp, conf)
+        hwmon.set_root(tmp)
+        control = controller.controller_from_config(conf)
+    inputs = attach_memory_attributes(control)
+    replayed = [(idx, control.sensors_by_name[name]) for idx, name in enumerate(reader.sensor_names)
+                if name in control.sensors_by_name]
+
+    fan_seconds = [0.0] * len(control.fans)
+    next_due = None
+    last_time = None
+    for timestamp, values, _, _, _ in reader.records():
+        if last_time is not None:
+            elapsed = timestamp - last_time
+            for idx, duty in enumerate(control.fan_duty):
+                if duty is not None:
+                    fan_seconds[idx] += duty / 100.0 * elapsed
+        last_time = timestamp
+
+        for idx, sensor in replayed:
+            value = values[idx]
+            if not math.isnan(value):
+                inputs[sensor.name].value = (value - sensor.offset) * sensor.divisor
+        if next_due is None or next_due <= timestamp:
+            next_due = control._loop_iter(timestamp)
+
+    control.sampler.shutdown()
+
+    return {
+        "config": config_path,
+        "fan_seconds": dict(zip([fan.name for fan in control.fans], fan_seconds)),
+        "writes": {fan.name: fan.writes_issued for fan in control.fans},
+    }
+
+
+def recorded_peaks(reader: TraceReader) -> dict[str, float]:
+    """Returns the highest reading of each sensor in the trace"""
+    peak = {name: -math.inf for name in reader.sensor_names}
+    for _, values, _, _, _ in reader.records():
+        for name, value in zip(reader.sensor_names, values):
+            if value > peak[name]:
+                peak[name] = value
+    return peak
+
+
+def arg_parse():
+    """Basic argument parsing"""
+    parser = argparse.ArgumentParser(
+        description="Replay a hhfc trace against one or more configurations"
+    )
+    parser.add_argument('trace',
+                        type=str,
+                        help="Trace file recorded with TRACE_FILE"
+                        )
+    parser.add_argument('-c', '--config-file',
+                        action='store',
+                        type=str,
+                        nargs='+',
+                        required=True,
+                        help="Configuration files to compare"
+                        )
+    return parser.parse_args()
+
+
+def main():
+    """Replay a trace and print a summary for each configuration"""
+    args = arg_parse()
+    logging.basicConfig(level=logging.WARNING)
+
+    reader = TraceReader(args.trace)
+    records = len(reader)
+    duration = 0.0
+    if records > 1:
+        timestamps = [record[0] for record in reader.records()]
+        duration = timestamps[-1] - timestamps[0]
+    print(f"{args.trace}: {records} records, {duration:.0f}s")
+    # Replay is open loop, temperatures are the recorded ones for every
+    # configuration
+    for name, peak in recorded_peaks(reader).items():
+        print(f"  sensor {name}: recorded peak {peak:.1f}, the same for every configuration")
+
+    for config_path in args.config_file:
+        result = replay(reader, config_path)
+        print(f"{result['config']}:")
+        print(f"  total fan-seconds: {sum(result['fan_seconds'].values()):.1f}")
+        for name, fan_seconds in result["fan_seconds"].items():
+            print(f"  fan {name}: {fan_seconds:.1f} fan-seconds, "
+                  f"{result['writes'][name]} PWM writes")
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import concurrent.futures
+import logging
+import time
+from hhfc.sensor import Sensor
+
+
+def _timed_read(sensor: Sensor) -> tuple[float, float, float]:
+    """Read a sensor and return the value with the time it was read and how
+    long the read took
+    """
+    start = time.monotonic()
+    value = sensor.read_input()
+    end = time.monotonic()
+    return value, end, end - start
+
+
+class Sampler:
+    """Sampling engine that reads sensors one after another"""
+
+    def sample(self, sensors: list[Sensor]) -> None:
+        """Read all `sensors` and update their values"""
+        for sensor in sensors:
+            sensor.sample()
+
+    def shutdown(self) -> None:
+        """Release any resources held by the sampler"""
+
+
+class ConcurrentSampler(Sampler):
+    """Sampling engine that reads sensors in parallel with a thread pool.
+    Sensors not answering before their timeout keep the last good value, a
+    stuck read is not issued again until it finishes
+    """
+
+    workers: int
+    pending: dict
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pending = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="hhfc-sampler"
+        )
+
+    def sample(self, sensors: list[Sensor]) -> None:
+        start = time.monotonic()
+        for sensor in sensors:
+            future = self.pending.get(sensor)
+            if future is not None and future.done():
+                # A late reading from a previous iteration, better than nothing
+                self._collect(sensor, future)
+                future = None
+            if future is None:
+                self.pending[sensor] = self._executor.submit(_timed_read, sensor)
+
+        for sensor in sorted(sensors, key=lambda sens: sens.timeout):
+            future = self.pending[sensor]
+            remaining = start + sensor.timeout - time.monotonic()
+            try:
+                future.result(timeout=max(remaining, 0))
+            except concurrent.futures.TimeoutError:
+                if sensor.value is None:
+                    logging.warning("Sensor '%s' is late and has no value yet", sensor.name)
+                else:
+                    logging.warning("Sensor '%s' is late, using value from %.2fs ago",
+                                    sensor.name,
+                                    sensor.get_age()
+                                    )
+                continue
+            except Exception:
+                del self.pending[sensor]
+                raise
+            self._collect(sensor, future)
+
+    def _collect(self, sensor: Sensor, future: concurrent.futures.Future) -> None:
+        """Update the sensor with a finished read"""
+        del self.pending[sensor]
+        sensor.update(*future.result())
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.pending.clear()
@@ -16,32 +16,114 @@ A PARTICULAR PURPOSE. See the GNU General Public License for more details.
 with hhfc. If not, see <https://www.gnu.org/licenses/>.
 """
 
-from . import util
+import math
+import time
+from .hwmon import Attribute, Device
+from .filters import Filter, filter_from_config
 
 
 class Sensor:
     """Class to represent a hwmon Sensor"""
 
+    __slots__ = (
+        "name", "driver_name", "device", "sensor_input", "divisor", "offset",
+        "interval", "timeout", "filter", "raw_value", "value", "timestamp",
+        "latency", "samples",
+    )
+
     name: str
     driver_name: str
-    temp_input: str
+    device: Device
+    sensor_input: Attribute
     divisor: float
     offset: float
-    curve: dict
+    interval: float
+    timeout: float
+    filter: Filter
+    raw_value: float
+    value: float
+    timestamp: float
+    latency: float
+    samples: int
 
     def __init__(self, sensor_config: dict):
-        full_path = util.find_driver_path(sensor_config["driver_name"])
-
         self.name = sensor_config["name"]
         self.driver_name = sensor_config["driver_name"]
-        self.sensor_input = full_path + sensor_config["temp_input"]
+        self.device = Device(sensor_config["driver_name"], sensor_config["device"])
+        self.sensor_input = self.device.attribute(sensor_config["temp_input"])
         self.divisor = sensor_config["divisor"] if "divisor" in sensor_config else 1
         self.offset = sensor_config["offset"] if "offset" in sensor_config else 0
+        self.interval = sensor_config["interval"]
+        self.timeout = sensor_config["timeout"]
+        self.filter = filter_from_config(sensor_config)
+        self.raw_value = None
+        self.value = None
+        self.timestamp = None
+        self.latency = None
+        self.samples = 0
 
     def read_input(self) -> float:
         """Check if we are controlling this fan"""
-        with open(self.sensor_input, "r", encoding="utf-8") as raw_reading:
-            return float(raw_reading.read()) / self.divisor + self.offset
+        return self.sensor_input.read_float() / self.divisor + self.offset
+
+    def sample(self) -> float:
+        """Read the sensor and keep the value as the last good reading"""
+        start = time.monotonic()
+        value = self.read_input()
+        end = time.monotonic()
+        self.update(value, end, end - start)
+        return self.value
+
+    def update(self, value: float, timestamp: float = None, latency: float = None) -> None:
+        """Store `value` as the last good reading, read at `timestamp` and
+        taking `latency` seconds. If the sensor has a filter `value` is the
+        filtered reading and `raw_value` the one read
+        """
+        self.raw_value = value
+        self.value = value if self.filter is None else self.filter.update(value)
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        self.latency = latency
+        self.samples += 1
+
+    def get_age(self) -> float:
+        """Seconds since the last good reading, infinite if there is none"""
+        if self.timestamp is None:
+            return math.inf
+        return time.monotonic() - self.timestamp
+
+    def close(self) -> None:
+        """Close the hwmon attribute of this sensor, it is opened again when
+        next used
+        """
+        self.sensor_input.close()
+
+    def reset_filter(self) -> None:
+        """Forget the past readings of the filter, i.e. after a suspend"""
+        if self.filter is not None:
+            self.filter.reset()
+
+    def same_hardware(self, other: "Sensor") -> bool:
+        """Whether `other` reads the same hwmon attribute as this sensor"""
+        return self.sensor_input.path == other.sensor_input.path
+
+    def adopt(self, other: "Sensor") -> None:
+        """Take over the open attribute and last reading of `other`, a sensor
+        reading the same hardware
+        """
+        self.device = other.device
+        self.sensor_input = other.sensor_input
+        if self.divisor == other.divisor and self.offset == other.offset:
+            if self.filter is None:
+                self.value = other.raw_value
+            elif other.filter is not None and self.filter.same_settings(other.filter):
+                self.filter = other.filter
+                self.value = other.value
+            elif other.raw_value is not None:
+                self.value = self.filter.update(other.raw_value)
+            self.raw_value = other.raw_value
+            self.timestamp = other.timestamp
+            self.latency = other.latency
+            self.samples = other.samples
 
     def __str__(self) -> str:
         """String representation of the sensor"""
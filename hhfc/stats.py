@@ -0,0 +1,129 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import logging
+
+# Upper bounds of the histogram buckets, in seconds. The last bucket holds
+# anything above the last bound
+BUCKET_BOUNDS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0,
+)
+
+
+class Histogram:
+    """Histogram of durations with fixed buckets"""
+
+    counts: list[int]
+    count: int
+    total: float
+    maximum: float
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value: float) -> None:
+        """Add a duration in seconds"""
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def reset(self) -> None:
+        """Forget all durations"""
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def percentile(self, percent: float) -> float:
+        """Returns the upper bound of the bucket holding the given percentile,
+        capped at the maximum duration
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100.0
+        accumulated = 0
+        for idx, count in enumerate(self.counts):
+            accumulated += count
+            if accumulated >= target:
+                if idx < len(BUCKET_BOUNDS):
+                    return min(BUCKET_BOUNDS[idx], self.maximum)
+                return self.maximum
+        return self.maximum
+
+    def mean(self) -> float:
+        """Returns the mean duration"""
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self) -> str:
+        return (f"n={self.count} avg={self.mean() * 1000:.2f}ms "
+                f"p50<={self.percentile(50) * 1000:.2f}ms "
+                f"p99<={self.percentile(99) * 1000:.2f}ms "
+                f"max={self.maximum * 1000:.2f}ms")
+
+
+class LoopStats:
+    """Timing statistics of the control loop. Durations are kept since the
+    last call to `reset`
+    """
+
+    tick: Histogram
+    sensor_read: dict[str, Histogram]
+    fan_write: dict[str, Histogram]
+    missed_deadlines: int
+    alarms: int
+
+    def __init__(self, sensor_names: list[str], fan_names: list[str]):
+        self.tick = Histogram()
+        self.sensor_read = {name: Histogram() for name in sensor_names}
+        self.fan_write = {name: Histogram() for name in fan_names}
+        self.missed_deadlines = 0
+        self.alarms = 0
+
+    def reset(self) -> None:
+        """Start a new statistics window"""
+        self.tick.reset()
+        for histogram in self.sensor_read.values():
+            histogram.reset()
+        for histogram in self.fan_write.values():
+            histogram.reset()
+        self.missed_deadlines = 0
+        self.alarms = 0
+
+    def log(self, level: int = logging.INFO) -> None:
+        """Write the statistics to the log"""
+        if not logging.getLogger().isEnabledFor(level):
+            return
+        logging.log(level, "Loop ticks: %s, missed deadlines: %i, sensor alarms: %i",
+                    self.tick,
+                    self.missed_deadlines,
+                    self.alarms
+                    )
+        for name, histogram in self.sensor_read.items():
+            logging.log(level, "Sensor '%s' reads: %s", name, histogram)
+        for name, histogram in self.fan_write.items():
+            logging.log(level, "Fan '%s' writes: %s", name, histogram)
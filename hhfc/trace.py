@@ -0,0 +1,208 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import math
+import mmap
+import os
+import struct
+
+# File identification
+MAGIC = b"HHFCTRC1"
+VERSION = 1
+
+# Header after the magic: version, number of sensors, number of fans and the
+# length of the names block
+HEADER = struct.Struct("<HHHI")
+
+# Records are written in batches of this many
+FLUSH_RECORDS = 64
+
+
+def record_struct(sensors: int, fans: int) -> struct.Struct:
+    """Returns the fixed size record layout for a number of sensors and fans:
+    timestamp, unfiltered sensor values, fan duty cycles, raw PWM values and
+    RPMs.
+    Missing values are stored as NaN or -1
+    """
+    return struct.Struct(f"<d{sensors}f{fans}f{fans}i{fans}i")
+
+
+def _header(sensor_names: list[str], fan_names: list[str]) -> bytes:
+    """Build the file header, padded to 8 bytes so records are aligned"""
+    names = "\n".join(sensor_names + fan_names).encode("utf-8")
+    header = MAGIC + HEADER.pack(VERSION, len(sensor_names), len(fan_names), len(names)) + names
+    return header + b"\0" * (-len(header) % 8)
+
+
+class TraceWriter:
+    """Append only writer of a binary trace of the control loop. Each loop
+    iteration is a fixed size record, see `record_struct`. If the file exists
+    and is a trace of the same sensors and fans records are appended,
+    otherwise it is kept with an ".old" suffix and a new trace is started
+    """
+
+    path: str
+    sensor_names: list[str]
+    fan_names: list[str]
+
+    def __init__(self, path: str, sensor_names: list[str], fan_names: list[str]):
+        self.path = path
+        self.sensor_names = sensor_names
+        self.fan_names = fan_names
+        self._struct = record_struct(len(sensor_names), len(fan_names))
+        self._buffer = bytearray(self._struct.size * FLUSH_RECORDS)
+        self._pending = 0
+        self._values = [0] * (1 + len(sensor_names) + 3 * len(fan_names))
+        self._file = self._open()
+
+    def _open(self):
+        """Open the trace for appending, writing the header if new"""
+        header = _header(self.sensor_names, self.fan_names)
+        trace = open(self.path, "a+b")
+        trace.seek(0)
+        existing = trace.read(len(header))
+        if not existing:
+            trace.write(header)
+            trace.flush()
+            return trace
+        if existing != header:
+            trace.close()
+            logging.warning("Trace %s was recorded with other sensors or fans, moving it to %s.old",
+                            self.path,
+                            self.path
+                            )
+            os.replace(self.path, self.path + ".old")
+            return self._open()
+        # Drop any partial record left by an interrupted write
+        size = os.fstat(trace.fileno()).st_size
+        whole = len(header) + (size - len(header)) // self._struct.size * self._struct.size
+        if whole != size:
+            trace.truncate(whole)
+        return trace
+
+    def record(self,
+               timestamp: float,
+               sensor_values: list[float],
+               fans: list,
+               fan_duty: list[int]
+               ) -> None:
+        """Add a record with the state of the control loop"""
+        values = self._values
+        values[0] = timestamp
+        pos = 1
+        for value in sensor_values:
+            values[pos] = math.nan if value is None else value
+            pos += 1
+        for duty in fan_duty:
+            values[pos] = math.nan if duty is None else duty
+            pos += 1
+        for fan in fans:
+            values[pos] = -1 if fan.last_pwm is None else fan.last_pwm
+            pos += 1
+        for fan in fans:
+            values[pos] = -1 if fan.rpm is None else fan.rpm
+            pos += 1
+        self._struct.pack_into(self._buffer, self._pending * self._struct.size, *values)
+        self._pending += 1
+        if self._pending == FLUSH_RECORDS:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write pending records to the file"""
+        if self._pending:
+            self._file.write(memoryview(self._buffer)[:self._pending * self._struct.size])
+            self._file.flush()
+            self._pending = 0
+
+    def close(self) -> None:
+        """Flush pending records and close the file"""
+        self.flush()
+        self._file.close()
+
+    def restart(self, sensor_names: list[str], fan_names: list[str]) -> None:
+        """Start a new trace for other sensors and fans. The current file is
+        kept with an ".old" suffix
+        """
+        self.close()
+        os.replace(self.path, self.path + ".old")
+        self.sensor_names = sensor_names
+        self.fan_names = fan_names
+        self._struct = record_struct(len(sensor_names), len(fan_names))
+        self._buffer = bytearray(self._struct.size * FLUSH_RECORDS)
+        self._values = [0] * (1 + len(sensor_names) + 3 * len(fan_names))
+        self._file = self._open()
+
+
+class TraceReader:
+    """Memory mapped reader of a trace written by TraceWriter"""
+
+    path: str
+    sensor_names: list[str]
+    fan_names: list[str]
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as trace:
+            self._map = mmap.mmap(trace.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a hhfc trace")
+        version, sensors, fans, names_len = HEADER.unpack_from(self._map, len(MAGIC))
+        if version != VERSION:
+            raise ValueError(f"Unsupported trace version {version}")
+        start = len(MAGIC) + HEADER.size
+        names = self._map[start:start + names_len].decode("utf-8").split("\n") if names_len else []
+        self.sensor_names = names[:sensors]
+        self.fan_names = names[sensors:]
+        self._offset = start + names_len + (-(start + names_len) % 8)
+        self._struct = record_struct(sensors, fans)
+
+    def __len__(self) -> int:
+        return (len(self._map) - self._offset) // self._struct.size
+
+    def records(self):
+        """Iterate over the records as tuples of (timestamp, sensor values,
+        fan duty cycles, PWM values, RPMs). Timestamps are wall clock times,
+        a step back of the clock while recording (i.e. set by NTP) is taken
+        as no time passing so they never decrease
+        """
+        sensors = len(self.sensor_names)
+        fans = len(self.fan_names)
+        end = self._offset + len(self) * self._struct.size
+        view = memoryview(self._map)[self._offset:end]
+        shift = 0.0
+        last = -math.inf
+        try:
+            for values in self._struct.iter_unpack(view):
+                timestamp = values[0] + shift
+                if timestamp < last:
+                    shift += last - timestamp
+                    timestamp = last
+                last = timestamp
+                pos = 1 + sensors
+                yield (timestamp,
+                       values[1:pos],
+                       values[pos:pos + fans],
+                       values[pos + fans:pos + 2 * fans],
+                       values[pos + 2 * fans:])
+        finally:
+            view.release()
+
+    def close(self) -> None:
+        """Unmap the trace"""
+        self._map.close()
@@ -0,0 +1,370 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import logging
+import tempfile
+import numpy as np
+from hhfc import config, hwmon
+from hhfc.batch import desired_duty_cycles, limit_duty_cycles, linear_curves
+from hhfc.fan import Fan
+from hhfc.replay import create_tree
+from hhfc.trace import TraceReader
+
+# Records further apart than this many times the median interval, i.e. the
+# machine was suspended or hhfc stopped, are not used to fit the model
+GAP_FACTOR = 10.0
+
+# The load is assumed constant for this many seconds when fitting the model
+LOAD_WINDOW = 60.0
+
+# Lowest cooling without fans the model accepts, per second
+MIN_IDLE_COOLING = 1e-6
+
+# Give up looking for better curves after this many rounds
+MAX_ROUNDS = 100
+
+
+class ThermalModel:
+    """First order thermal model of a sensor cooled by a fan:
+
+        dT/dt = load - (idle_cooling + fan_cooling * duty) (T - ambient)
+
+    with duty as a fraction. `idle_cooling` and `fan_cooling` are fitted from
+    a trace by least squares. The load of each record is then what makes the
+    model follow the recorded temperatures exactly with the recorded duty
+    cycles, so other duty cycles can be simulated against the same workload
+    """
+
+    ambient: float
+    idle_cooling: float
+    fan_cooling: float
+
+    def __init__(self, ambient: float, idle_cooling: float, fan_cooling: float):
+        self.ambient = ambient
+        self.idle_cooling = idle_cooling
+        self.fan_cooling = fan_cooling
+
+    @classmethod
+    def fit(cls, starts, ends, duty_cycles, intervals, windows, ambient: float) -> "ThermalModel":
+        """Fit the cooling terms to pairs of consecutive recorded
+        temperatures, `intervals` seconds apart, with the duty cycles in
+        percent set at the first of each pair. The load is taken as constant
+        within each window, numbered by `windows`, and removed by subtracting
+        the window averages. Otherwise a higher load, that raises both the
+        temperature and the duty cycle, would look like fans not cooling
+        """
+        excess = np.asarray(starts) - ambient
+        duty = np.asarray(duty_cycles) / 100.0
+        rates = (np.asarray(ends) - starts) / intervals
+        counts = np.bincount(windows)
+        counts[counts == 0] = 1
+
+        def demean(values):
+            return values - (np.bincount(windows, values) / counts)[windows]
+
+        terms = np.column_stack((-demean(excess), -demean(duty * excess)))
+        (idle_cooling, fan_cooling), *_ = np.linalg.lstsq(terms, demean(rates), rcond=None)
+        if fan_cooling <= 0:
+            raise ValueError("The fan does not cool the sensor in this trace, can't fit a model")
+        # Some cooling is left with fans stopped, or temperatures would grow
+        # without limit
+        return cls(ambient, max(idle_cooling, MIN_IDLE_COOLING), fan_cooling)
+
+    def _cooling(self, duty_cycles) -> np.ndarray:
+        return self.idle_cooling + self.fan_cooling * np.asarray(duty_cycles) / 100.0
+
+    def loads(self, starts, ends, duty_cycles, intervals) -> np.ndarray:
+        """Load taking each recorded temperature in `starts` to the one in
+        `ends` with the recorded duty cycles
+        """
+        cooling = self._cooling(duty_cycles)
+        decay = np.exp(-cooling * intervals)
+        balance = (np.asarray(ends) - np.asarray(starts) * decay) / (1.0 - decay)
+        return cooling * (balance - self.ambient)
+
+    def step(self, temperatures, duty_cycles, load: float, interval: float) -> np.ndarray:
+        """Temperatures after `interval` seconds under `load` at constant duty
+        cycles. Solved exactly, so it is stable for any interval
+        """
+        cooling = self._cooling(duty_cycles)
+        balance = self.ambient + load / cooling
+        return balance + (temperatures - balance) * np.exp(-cooling * interval)
+
+
+def load_trace(path: str, sensor: str, fan: str, step: float) -> tuple:
+    """Read the temperatures of `sensor` and duty cycles of `fan` from a
+    trace. Records with missing values are dropped. With `step`, records are
+    averaged in groups spanning about that many seconds. Returns the
+    temperatures, duty cycles, the seconds from each record to the next and
+    the trace sensor values by name
+    """
+    reader = TraceReader(path)
+    if sensor not in reader.sensor_names:
+        raise ValueError(f"Sensor {sensor} not in trace")
+    if fan not in reader.fan_names:
+        raise ValueError(f"Fan {fan} not in trace")
+    sensor_idx = reader.sensor_names.index(sensor)
+    fan_idx = reader.fan_names.index(fan)
+    rows = [(timestamp, values, duty[fan_idx])
+            for timestamp, values, duty, _, _ in reader.records()]
+    reader.close()
+
+    timestamps = np.array([row[0] for row in rows])
+    values = np.array([row[1] for row in rows], dtype=float).reshape(len(rows), -1)
+    duty = np.array([row[2] for row in rows], dtype=float)
+    valid = ~np.isnan(values[:, sensor_idx]) & ~np.isnan(duty)
+    timestamps, values, duty = timestamps[valid], values[valid], duty[valid]
+    if len(timestamps) < 3:
+        raise ValueError("Not enough records in trace")
+
+    if step:
+        groups = ((timestamps - timestamps[0]) // step).astype(int)
+        _, starts = np.unique(groups, return_index=True)
+        counts = np.diff(np.append(starts, len(groups)))
+        timestamps = timestamps[starts]
+        values = np.add.reduceat(values, starts) / counts[:, np.newaxis]
+        duty = np.add.reduceat(duty, starts) / counts
+    sensors = {name: values[:, idx] for idx, name in enumerate(reader.sensor_names)}
+    return values[:, sensor_idx], duty, np.diff(timestamps), sensors
+
+
+def simulate(model: ThermalModel,
+             fan: Fan,
+             x_vals,
+             curves,
+             other_duty,
+             loads,
+             intervals,
+             start: float
+             ) -> tuple:
+    """Run the model with each of `curves` (an array of duty cycles at
+    `x_vals` per curve) driving the fan, with the fan policy applied and at
+    least `other_duty`, the duty cycles from its other sensors. `loads`,
+    `intervals` and `other_duty` have an entry per step. Returns the time
+    averaged duty cycle and peak temperature of each curve
+    """
+    temps = np.full(len(curves), start)
+    peak = temps.copy()
+    total = np.zeros(len(curves))
+    for idx, interval in enumerate(intervals):
+        duty = limit_duty_cycles(fan, linear_curves(x_vals, curves, temps))
+        duty = np.maximum(duty, other_duty[idx])
+        total += duty * interval
+        temps = model.step(temps, duty, loads[idx], interval)
+        np.maximum(peak, temps, out=peak)
+    return total / intervals.sum(), peak
+
+
+def _candidates(curve: np.ndarray, duty_step: float) -> np.ndarray:
+    """Curves differing from `curve` in a single point, and curves with a
+    point lowered together with every point left of it, keeping duty cycles
+    non decreasing with temperature. The latter let a curve at full speed
+    everywhere come down, where no single point can move but the first
+    """
+    levels = np.arange(0.0, 100.0 + duty_step / 2, duty_step)
+    candidates = []
+    for idx, current in enumerate(curve):
+        low = curve[idx - 1] if idx > 0 else 0.0
+        high = curve[idx + 1] if idx < len(curve) - 1 else 100.0
+        for level in levels[(levels >= low) & (levels <= high) & (levels != current)]:
+            candidate = curve.copy()
+            candidate[idx] = level
+            candidates.append(candidate)
+        if idx > 0:
+            for level in levels[levels < low]:
+                candidate = curve.copy()
+                candidate[:idx + 1] = np.minimum(candidate[:idx + 1], level)
+                candidates.append(candidate)
+    return np.array(candidates).reshape(-1, len(curve))
+
+
+def optimize(model: ThermalModel,
+             fan: Fan,
+             x_vals,
+             curve,
+             other_duty,
+             loads,
+             intervals,
+             start: float,
+             max_temperature: float,
+             duty_step: float
+             ) -> tuple:
+    """Search the duty cycles at `x_vals` with the lowest average duty cycle
+    keeping the simulated temperature under `max_temperature`. The best of
+    the moves from `_candidates` is taken until no move improves. Returns the
+    curve, its average duty cycle and peak temperature
+    """
+    def run(curves):
+        return simulate(model, fan, x_vals, curves, other_duty, loads, intervals, start)
+
+    curve = np.maximum.accumulate(np.asarray(curve, dtype=float))
+    (mean,), (peak,) = run(curve[np.newaxis])
+    if peak > max_temperature:
+        logging.info("Current curve peaks at %.1f, starting from full speed", peak)
+        curve = np.full(len(x_vals), 100.0)
+        (mean,), (peak,) = run(curve[np.newaxis])
+        if peak > max_temperature:
+            raise ValueError(f"{max_temperature:.1f} can't be held even at full speed, "
+                             f"model peak {peak:.1f}")
+
+    for rounds in range(MAX_ROUNDS):
+        candidates = _candidates(curve, duty_step)
+        if not len(candidates):
+            break
+        means, peaks = run(candidates)
+        means[peaks > max_temperature] = np.inf
+        best = np.argmin(means)
+        if not means[best] < mean - 1e-9:
+            break
+        curve, mean, peak = candidates[best], means[best], peaks[best]
+        logging.debug("Round %i: %s, average duty %.2f%%, peak %.1f", rounds, curve, mean, peak)
+    return curve, mean, peak
+
+
+def _format_curve(x_vals, curve) -> str:
+    return "[" + ", ".join(f"[{x:g}, {y:g}]" for x, y in zip(x_vals, curve)) + "]"
+
+
+def tune(args) -> None:
+    """Fit the model and print the current and tuned curves"""
+    conf = config.Config(args.config_file)
+    fans_conf = conf.get_fans_config()
+    for zone in conf.get_zones_config():
+        fans_conf = fans_conf + zone["fans"]
+    with tempfile.TemporaryDirectory(prefix="hhfc-tune-") as tmp:
+        create_tree(tmp, conf)
+        hwmon.set_root(tmp)
+        fans = {fan_conf["name"]: Fan(fan_conf) for fan_conf in fans_conf}
+    if args.fan not in fans:
+        raise ValueError(f"No fan named {args.fan} in {args.config_file}")
+    fan = fans[args.fan]
+    sensor = args.sensor
+    if sensor is None:
+        if len(fan.sensors) != 1:
+            raise ValueError(f"Fan {fan.name} uses more than one sensor, choose one with --sensor")
+        sensor = fan.sensors[0]["name"]
+    if fan.mode != "curve":
+        raise ValueError(f"Fan {fan.name} is not controlled by a curve")
+    if sensor not in fan.interpolator:
+        raise ValueError(f"Fan {fan.name} does not use sensor {sensor}")
+    if fan.interpolation != "linear":
+        raise ValueError("Only linear curves can be tuned, "
+                         f"fan {fan.name} uses {fan.interpolation}")
+
+    temps, duty, intervals, sensors = load_trace(args.trace, sensor, fan.name, args.step)
+    starts, ends, duty = temps[:-1], temps[1:], duty[:-1]
+    # Suspends and restarts are left out of the fit, and simulated as a
+    # single regular step
+    usable = intervals <= np.median(intervals) * GAP_FACTOR
+    windows = (np.cumsum(intervals) // LOAD_WINDOW).astype(int)
+    model = ThermalModel.fit(starts[usable], ends[usable], duty[usable], intervals[usable],
+                             windows[usable], args.ambient)
+    intervals[~usable] = np.median(intervals)
+    loads = model.loads(starts, ends, duty, intervals)
+
+    others = [sens["name"] for sens in fan.sensors if sens["name"] != sensor]
+    other_duty = np.zeros(len(intervals))
+    for name in others:
+        other_duty = np.maximum(other_duty, desired_duty_cycles(fan, name, sensors[name][:-1]))
+
+    curve_points = fan.get_sensor_curve(sensor)
+    x_vals = np.array([point[0] for point in sorted(curve_points)], dtype=float)
+    current = np.array([point[1] for point in sorted(curve_points)], dtype=float)
+    (current_mean,), (current_peak,) = simulate(model, fan, x_vals, current[np.newaxis], other_duty,
+                                                loads, intervals, temps[0])
+    tuned, tuned_mean, tuned_peak = optimize(model, fan, x_vals, current, other_duty,
+                                             loads, intervals, temps[0], args.max_temp,
+                                             args.duty_step)
+
+    print(f"fan {fan.name}, sensor {sensor}: {len(temps)} records, {intervals.sum():.0f}s")
+    print(f"  model: cooling {model.idle_cooling:.5f} + {model.fan_cooling:.5f} x duty per second, "
+          f"ambient {model.ambient:.1f}")
+    print(f"  current: {_format_curve(x_vals, current)}, "
+          f"average duty {current_mean:.1f}%, peak {current_peak:.1f}")
+    print(f"  tuned:   {_format_curve(x_vals, tuned)}, "
+          f"average duty {tuned_mean:.1f}%, peak {tuned_peak:.1f}")
+
+
+def arg_parse():
+    """Basic argument parsing"""
+    parser = argparse.ArgumentParser(
+        description="Tune the curve of a fan against a thermal model fitted from a hhfc trace"
+    )
+    parser.add_argument('trace',
+                        type=str,
+                        help="Trace file recorded with TRACE_FILE"
+                        )
+    parser.add_argument('-c', '--config-file',
+                        action='store',
+                        type=str,
+                        required=True,
+                        help="Configuration file with the fan to tune"
+                        )
+    parser.add_argument('-f', '--fan',
+                        action='store',
+                        type=str,
+                        required=True,
+                        help="Name of the fan to tune"
+                        )
+    parser.add_argument('-s', '--sensor',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help="Sensor whose curve is tuned, needed if the fan uses more than one"
+                        )
+    parser.add_argument('-t', '--max-temp',
+                        action='store',
+                        type=float,
+                        required=True,
+                        help="Highest temperature the tuned curve may reach"
+                        )
+    parser.add_argument('--ambient',
+                        action='store',
+                        type=float,
+                        default=25.0,
+                        help="Ambient temperature assumed by the thermal model"
+                        )
+    parser.add_argument('--duty-step',
+                        action='store',
+                        type=float,
+                        default=5.0,
+                        help="Spacing of the duty cycles tried for each curve point"
+                        )
+    parser.add_argument('--step',
+                        action='store',
+                        type=float,
+                        default=0,
+                        help="Average records over this many seconds, faster on long traces"
+                        )
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help="Log each improvement found"
+                        )
+    return parser.parse_args()
+
+
+def main():
+    """Tune a fan curve and print it"""
+    args = arg_parse()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    tune(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,17 +17,25 @@ with hhfc. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import os
+import time
+from . import hwmon
 
-def find_driver_path(driver_name: str) -> str:
+def find_driver_path(driver_name: str, device: str = None) -> str:
     """Find hwmon driver with name `driver_name` and returns the full path to
-    its directory
+    its directory. If `device` is given the device path must match too
     """
-    base_path = "/sys/class/hwmon/"
-    for driver in os.listdir(base_path):
-        full_path = base_path + driver + "/"
-        with open(full_path + "name", encoding="utf-8") as driver_path:
-            test_name = driver_path.read().strip()
-        if driver_name == test_name:
-            return full_path
-
-    raise RuntimeError(f"Driver with name {driver_name} not found.")
+    return hwmon.index.find(driver_name, device)
+
+
+def process_age() -> float:
+    """Returns the seconds since this process started, with the resolution
+    of the kernel clock ticks. None if not known
+    """
+    try:
+        with open("/proc/self/stat", 'rb') as stat_file:
+            # Fields after the command name, which may contain spaces
+            fields = stat_file.read().rsplit(b")", 1)[1].split()
+        start = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - start
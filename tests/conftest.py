@@ -0,0 +1,75 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+import yaml
+from hhfc import config, controller, hwmon
+from hhfc.replay import attach_memory_attributes, create_tree
+
+
+class SimulatedController:
+    """A controller built from a configuration with in memory attributes,
+    as hhfc-replay runs it. Time only moves when `tick` is called
+    """
+
+    def __init__(self, control: controller.Controller, inputs: dict):
+        self.control = control
+        self.inputs = inputs
+        self.now = 0.0
+
+    def set_temperature(self, name: str, degrees: float) -> None:
+        """Set the reading of the sensor `name`"""
+        sensor = self.control.sensors_by_name[name]
+        self.inputs[name].value = (degrees - sensor.offset) * sensor.divisor
+
+    def tick(self, seconds: float = 1.0) -> None:
+        """Run one iteration of the control loop `seconds` after the last"""
+        self.control._loop_iter(self.now)
+        self.now += seconds
+
+    def pwm(self, fan_idx: int = 0) -> int:
+        """Last value written to the PWM attribute of a fan"""
+        return self.control.fans[fan_idx].pwm_input.value
+
+    def duty(self, fan_idx: int = 0) -> int:
+        """Duty cycle the controller reports for a fan"""
+        return self.control.fan_duty[fan_idx]
+
+
+@pytest.fixture
+def simulated_controller(tmp_path):
+    """Returns a function building a SimulatedController from a
+    configuration given as a dict
+    """
+    controllers = []
+
+    def build(conf_data: dict) -> SimulatedController:
+        path = tmp_path / "hhfc.yaml"
+        path.write_text(yaml.safe_dump(conf_data), encoding="utf-8")
+        conf = config.Config(str(path))
+        root = tmp_path / "hwmon"
+        root.mkdir(exist_ok=True)
+        create_tree(str(root), conf)
+        hwmon.set_root(str(root))
+        control = controller.controller_from_config(conf)
+        controllers.append(control)
+        return SimulatedController(control, attach_memory_attributes(control))
+
+    yield build
+    for control in controllers:
+        control.sampler.shutdown()
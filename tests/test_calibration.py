@@ -0,0 +1,70 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+from hhfc.fan import FanCalibration
+
+
+def calibration() -> FanCalibration:
+    return FanCalibration("/sys/class/hwmon/hwmon2/pwm1",
+                          [(255, 3000), (0, 0), (50, 0), (80, 1000), (160, 2000)],
+                          stall_pwm=70,
+                          start_pwm=90
+                          )
+
+
+def test_limits():
+    fan = calibration()
+    assert fan.max_rpm == 3000
+    assert fan.get_pwm(0) == 0
+    assert fan.get_pwm(100, last_pwm=200) == 255
+
+
+def test_linear_in_speed():
+    fan = calibration()
+    # 1500 RPM, half way between the 80 and 160 PWM points
+    assert fan.get_pwm(50, last_pwm=100) == 120
+    assert fan.get_pwm(100 / 3, last_pwm=100) == 80
+
+
+def test_stall_and_start():
+    fan = calibration()
+    # 300 RPM would be PWM 24, the fan stalls under 70
+    assert fan.get_pwm(10, last_pwm=120) == 70
+    # A stopped or unknown fan needs start_pwm to spin up
+    assert fan.get_pwm(10) == 90
+    assert fan.get_pwm(10, last_pwm=0) == 90
+    assert fan.get_pwm(50, last_pwm=0) == 120
+
+
+def test_speed_noise_is_flattened():
+    fan = FanCalibration("pwm1", [(0, 0), (100, 1500), (120, 1400), (255, 3000)], 0, 0)
+    pwms = [fan.get_pwm(duty, last_pwm=255) for duty in range(0, 101, 5)]
+    assert pwms == sorted(pwms)
+
+
+def test_round_trip():
+    fan = calibration()
+    copy = FanCalibration.from_dict(fan.to_dict())
+    assert copy.points == fan.points
+    assert [copy.get_pwm(duty) for duty in range(101)] == [fan.get_pwm(duty) for duty in range(101)]
+
+
+def test_needs_points():
+    with pytest.raises(ValueError):
+        FanCalibration("pwm1", [], 0, 0)
@@ -0,0 +1,132 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+def fan_config(**options) -> dict:
+    """A configuration with a cpu sensor and a fan following it from 0% at
+    50 degrees to 60% at 70 degrees
+    """
+    fan = {
+        "name": "fan1",
+        "driver_name": "oxpec",
+        "handle": "pwm1",
+        "fan_input": "fan1_input",
+        "minimum_duty_cycle": 30,
+        "sensors": [{"name": "cpu", "curve": [[50, 0], [70, 60]]}],
+    }
+    fan.update(options)
+    return {
+        "INTERVAL": 1.0,
+        "SENSORS": [{"name": "cpu", "driver_name": "k10temp", "temp_input": "temp1_input"}],
+        "FANS": [fan],
+    }
+
+
+def test_curve_duty_cycle(simulated_controller):
+    sim = simulated_controller(fan_config())
+    sim.set_temperature("cpu", 65)
+    sim.tick()
+    assert sim.duty() == 45
+    assert sim.pwm() == int(45 * 255 / 100)
+
+
+def test_ramp_starts_at_minimum_duty_cycle_with_shutoff(simulated_controller):
+    sim = simulated_controller(fan_config(allow_shutoff="yes", max_step_per_second=2))
+    sim.set_temperature("cpu", 45)
+    for _ in range(3):
+        sim.tick()
+    assert sim.duty() == 0
+    assert sim.pwm() == 0
+
+    sim.set_temperature("cpu", 75)
+    sim.tick()
+    assert sim.duty() == 32
+    assert sim.pwm() == int(32 * 255 / 100)
+    duties = []
+    for _ in range(20):
+        sim.tick()
+        duties.append(sim.duty())
+    assert duties == sorted(duties)
+    assert all(b - a <= 2 for a, b in zip(duties, duties[1:]))
+    assert duties[-1] == 60
+
+
+def test_ramp_down_reports_the_duty_set(simulated_controller):
+    sim = simulated_controller(fan_config(max_step_per_second=5))
+    sim.set_temperature("cpu", 75)
+    sim.tick()
+    sim.set_temperature("cpu", 45)
+    for _ in range(20):
+        sim.tick()
+        # Without shutoff the fan never goes under the minimum
+        assert sim.duty() >= 30
+        assert sim.pwm() == int(sim.duty() * 255 / 100)
+    assert sim.duty() == 30
+
+
+def test_hysteresis_follows_rises_and_holds_small_drops(simulated_controller):
+    sim = simulated_controller(fan_config(hysteresis=3))
+    sim.set_temperature("cpu", 65)
+    sim.tick()
+    assert sim.duty() == 45
+    sim.set_temperature("cpu", 63)
+    sim.tick()
+    assert sim.duty() == 45
+    sim.set_temperature("cpu", 67)
+    sim.tick()
+    assert sim.duty() == 51
+    sim.set_temperature("cpu", 60)
+    sim.tick()
+    assert sim.duty() == 39
+
+
+def test_hysteresis_stops_shutoff_toggling(simulated_controller):
+    sim = simulated_controller(fan_config(allow_shutoff="yes", hysteresis=3))
+    writes = sim.control.fans[0].writes_issued
+    duties = []
+    for tick in range(20):
+        # Around 60 degrees, where the curve crosses the 30% minimum
+        sim.set_temperature("cpu", 61 if tick % 2 else 59)
+        sim.tick()
+        duties.append(sim.duty())
+    assert duties[0] == 0
+    assert all(duty == 33 for duty in duties[1:])
+    assert sim.control.fans[0].writes_issued - writes == 2
+
+
+def test_hysteresis_with_ramp_and_shutoff(simulated_controller):
+    sim = simulated_controller(fan_config(allow_shutoff="yes", hysteresis=3, max_step_per_second=2))
+    sim.set_temperature("cpu", 45)
+    sim.tick()
+    sim.set_temperature("cpu", 70)
+    for _ in range(20):
+        sim.tick()
+    assert sim.duty() == 60
+    # A drop within the hysteresis does not start a ramp down
+    sim.set_temperature("cpu", 68)
+    sim.tick()
+    assert sim.duty() == 60
+    sim.set_temperature("cpu", 45)
+    duties = []
+    for _ in range(30):
+        sim.tick()
+        duties.append(sim.duty())
+    assert duties == sorted(duties, reverse=True)
+    assert all(duty == 0 or duty > 30 for duty in duties)
+    assert duties[-1] == 0
+    assert sim.pwm() == 0
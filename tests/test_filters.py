@@ -0,0 +1,85 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+from hhfc.filters import EmaFilter, MedianFilter, MovingAverageFilter, filter_from_config
+
+
+def test_ema_filter():
+    ema = EmaFilter(0.5)
+    assert ema.update(10) == 10
+    assert ema.update(20) == 15
+    assert ema.update(20) == 17.5
+    ema.reset()
+    assert ema.update(40) == 40
+
+
+def test_ema_filter_alpha_range():
+    with pytest.raises(ValueError):
+        EmaFilter(0)
+    with pytest.raises(ValueError):
+        EmaFilter(1.5)
+    assert EmaFilter(1).update(3) == 3
+
+
+def test_moving_average_filter():
+    average = MovingAverageFilter(3)
+    assert average.update(3) == 3
+    assert average.update(6) == 4.5
+    assert average.update(9) == 6
+    # The oldest reading leaves the window
+    assert average.update(12) == 9
+    average.reset()
+    assert average.update(1) == 1
+
+
+def test_median_filter_discards_spikes():
+    median = MedianFilter(3)
+    assert [median.update(value) for value in [50, 90, 51, 52, 20, 53]] == [50, 70, 51, 52, 51, 52]
+    median.reset()
+    assert median.update(30) == 30
+
+
+def test_median_filter_with_repeated_readings():
+    median = MedianFilter(4)
+    outputs = [median.update(value) for value in [5, 5, 5, 7, 7, 7, 7]]
+    assert outputs == [5, 5, 5, 5, 6, 7, 7]
+
+
+def test_filter_windows():
+    for kind in (MovingAverageFilter, MedianFilter):
+        with pytest.raises(ValueError):
+            kind(0)
+
+
+def test_same_settings():
+    assert EmaFilter(0.3).same_settings(EmaFilter(0.3))
+    assert not EmaFilter(0.3).same_settings(EmaFilter(0.4))
+    assert MedianFilter(5).same_settings(MedianFilter(5))
+    assert not MedianFilter(5).same_settings(MovingAverageFilter(5))
+    assert not MovingAverageFilter(5).same_settings(MovingAverageFilter(3))
+
+
+def test_filter_from_config():
+    conf = {"name": "cpu", "filter": "none", "filter_window": 5, "filter_alpha": 0.3}
+    assert filter_from_config(conf) is None
+    assert isinstance(filter_from_config(dict(conf, filter="ema")), EmaFilter)
+    assert isinstance(filter_from_config(dict(conf, filter="average")), MovingAverageFilter)
+    assert isinstance(filter_from_config(dict(conf, filter="median")), MedianFilter)
+    with pytest.raises(ValueError):
+        filter_from_config(dict(conf, filter="kalman"))
@@ -0,0 +1,52 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from hhfc import config
+from hhfc.pid import PidController
+
+
+def test_sustained_error_reaches_out_max():
+    pid = PidController(70, 1, 1.0, 0, 30, 100)
+    outputs = [pid.update(75, tick * 5) for tick in range(30)]
+    assert outputs[-1] == 100
+
+
+def test_sustained_error_reaches_out_max_with_default_gains():
+    pid = PidController(70,
+                        config.DEFAULT_FAN_PID_KP,
+                        config.DEFAULT_FAN_PID_KI,
+                        config.DEFAULT_FAN_PID_KD,
+                        30,
+                        100
+                        )
+    outputs = [pid.update(78, tick * 2) for tick in range(300)]
+    assert outputs[-1] == 100
+
+
+def test_saturation_does_not_wind_up():
+    pid = PidController(70, 1, 1.0, 0, 30, 100)
+    for tick in range(100):
+        pid.update(75, tick * 5)
+    # Below target the output leaves full duty on the next reading
+    assert pid.update(69, 500) < 100
+
+
+def test_sustained_negative_error_reaches_out_min():
+    pid = PidController(70, 1, 1.0, 0, 30, 100)
+    outputs = [pid.update(60, tick * 5) for tick in range(30)]
+    assert outputs[-1] == 30
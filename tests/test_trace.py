@@ -0,0 +1,111 @@
+"""
+Copyright 2022 Joaquín I. Aramendía <samsagax at gmail dot com>
+
+    This file is part of hhfc.
+
+    hhfc is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+    hhfc is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+with hhfc. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import os
+from hhfc.trace import TraceReader, TraceWriter
+
+
+class RecordedFan:
+    """Stand in for the fan state a trace records"""
+
+    def __init__(self, last_pwm: int = None, rpm: int = None):
+        self.last_pwm = last_pwm
+        self.rpm = rpm
+
+
+def read_all(path: str) -> tuple:
+    reader = TraceReader(path)
+    try:
+        return reader.sensor_names, reader.fan_names, list(reader.records())
+    finally:
+        reader.close()
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    writer = TraceWriter(path, ["cpu", "gpu"], ["fan1"])
+    writer.record(100.0, [50.5, None], [RecordedFan(128, 2400)], [50])
+    writer.record(101.0, [51.0, 60.25], [RecordedFan()], [None])
+    writer.close()
+
+    sensors, fans, records = read_all(path)
+    assert sensors == ["cpu", "gpu"]
+    assert fans == ["fan1"]
+    assert len(records) == 2
+    timestamp, values, duty, pwm, rpm = records[0]
+    assert timestamp == 100.0
+    assert values[0] == 50.5
+    assert math.isnan(values[1])
+    assert duty == (50,)
+    assert pwm == (128,)
+    assert rpm == (2400,)
+    timestamp, values, duty, pwm, rpm = records[1]
+    assert timestamp == 101.0
+    assert values == (51.0, 60.25)
+    assert math.isnan(duty[0])
+    assert pwm == (-1,)
+    assert rpm == (-1,)
+
+
+def test_records_are_flushed_in_batches(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    writer = TraceWriter(path, ["cpu"], ["fan1"])
+    for tick in range(200):
+        writer.record(float(tick), [40.0 + tick % 10], [RecordedFan(100, 1000)], [40])
+    writer.close()
+    _, _, records = read_all(path)
+    assert [record[0] for record in records] == [float(tick) for tick in range(200)]
+
+
+def test_append_to_same_trace(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    for start in (0.0, 10.0):
+        writer = TraceWriter(path, ["cpu"], ["fan1"])
+        writer.record(start, [40.0], [RecordedFan()], [30])
+        writer.close()
+    _, _, records = read_all(path)
+    assert [record[0] for record in records] == [0.0, 10.0]
+
+
+def test_other_sensors_start_a_new_trace(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    writer = TraceWriter(path, ["cpu"], ["fan1"])
+    writer.record(0.0, [40.0], [RecordedFan()], [30])
+    writer.close()
+    writer = TraceWriter(path, ["cpu", "gpu"], ["fan1"])
+    writer.record(1.0, [41.0, 50.0], [RecordedFan()], [30])
+    writer.close()
+
+    sensors, _, records = read_all(path)
+    assert sensors == ["cpu", "gpu"]
+    assert len(records) == 1
+    assert os.path.exists(path + ".old")
+    sensors, _, records = read_all(path + ".old")
+    assert sensors == ["cpu"]
+    assert len(records) == 1
+
+
+def test_clock_steps_back_are_not_negative_time(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    writer = TraceWriter(path, ["cpu"], ["fan1"])
+    for timestamp in [100.0, 101.0, 50.0, 51.0]:
+        writer.record(timestamp, [40.0], [RecordedFan()], [30])
+    writer.close()
+    _, _, records = read_all(path)
+    assert [record[0] for record in records] == [100.0, 101.0, 101.0, 102.0]